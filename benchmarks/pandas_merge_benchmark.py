@@ -0,0 +1,61 @@
+# Built in Modules
+import argparse
+import time
+
+# External packages
+import pandas as pd
+import numpy as np
+
+# Local package imports
+from pyprofqueue.profilers.data.read_prometheus import pandas_merge
+
+parser = argparse.ArgumentParser(description="Compare the wide frame build of read_prometheus.pandas_merge against "
+                                             "merging every series into the DataFrame one at a time.")
+parser.add_argument("-n", "--series", type=int, nargs='+', default=[10, 100, 5000],
+                    help="numbers of series to benchmark")
+parser.add_argument("-s", "--samples", type=int, default=720, help="samples per series, 720 is 2 hours at 10s")
+parser.add_argument("-r", "--repeats", type=int, default=3, help="repeats per measurement, the fastest is reported")
+
+
+def sequential_merge(dictionary: dict, dataframe: pd.DataFrame = None):
+    # pandas_merge as it was before the wide frame build, one pd.merge per series
+    for key in dictionary.keys():
+        if dataframe is None:
+            dataframe = pd.DataFrame({'Time': dictionary[key][:, 0], key: dictionary[key][:, 1]})
+        else:
+            dataframe = pd.merge(dataframe, pd.DataFrame({'Time': dictionary[key][:, 0],
+                                                          key: dictionary[key][:, 1]}), on='Time')
+    return dataframe
+
+
+def make_series(series: int, samples: int):
+    rng = np.random.default_rng(0)
+    times = 1.7e9 + 10.0 * np.arange(samples)
+    return {f'CPU Usage: {number}': np.column_stack([times, rng.uniform(0, 100, samples)])
+            for number in range(series)}
+
+
+def best_time(function, repeats: int):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    args = parser.parse_args()
+    print(f"{'series':>8} {'sequential [s]':>16} {'wide frame [s]':>16} {'speed up':>10}")
+    for series in args.series:
+        dictionary = make_series(series, args.samples)
+        reference = sequential_merge(dictionary)
+        if not reference.equals(pandas_merge(dictionary, join='inner')[0]):
+            exit(f"pandas_merge and the sequential merge disagree for {series} series.")
+        sequential = best_time(lambda: sequential_merge(dictionary), args.repeats)
+        wide = best_time(lambda: pandas_merge(dictionary), args.repeats)
+        print(f"{series:>8} {sequential:>16.4f} {wide:>16.4f} {sequential / wide:>9.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,8 @@ parameters = {
     'queue_name': 'PBS',
     'Option_Flag': '#PBS',
     'submission_command': 'qsub',
+    'parallel_launcher': 'pbsdsh -u',
+    'node_hostnames': 'sort -u ${PBS_NODEFILE}',
     'environment_variable':
         {
             'job_array_index': '${PBS_ARRAYID}',
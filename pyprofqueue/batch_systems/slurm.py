@@ -2,6 +2,8 @@ parameters = {
     'queue_name': 'Slurm',
     'Option_Flag': '#SBATCH',
     'submission_command': 'sbatch',
+    'parallel_launcher': 'srun --overlap --nodes=${SLURM_JOB_NUM_NODES} --ntasks-per-node=1',
+    'node_hostnames': 'scontrol show hostnames ${SLURM_JOB_NODELIST}',
     'environment_variable':
         {
             'job_array_index': '${SLURM_ARRAY_TASK_ID}',
@@ -0,0 +1,83 @@
+from importlib import resources as impresources
+import json
+import io
+
+from .profilers import data
+
+overhead_file_path = impresources.files(data) / "overhead_commands.txt"
+# Phases that only exist because of the profiling, as opposed to the work itself
+profiling_phase_prefixes = ('init_', 'end_')
+
+
+def define_functions(profilefile: io.TextIOWrapper):
+    '''
+    define_functions writes the bash functions into the profile file that the profile script and the profiler
+    templates use to record the wall time and CPU time of each of their phases, and to list the process ids of the
+    profiling processes.
+
+    Parameters
+    ----------
+    profilefile: io.TextIOWrapper = Open text file that can be written to and is being used to initiate, call and
+        terminate all profiling codes that are to be executed with the user specified bash script.
+
+    Returns
+    -------
+    None
+    '''
+    with open(overhead_file_path, 'r') as read_file:
+        for line in read_file:
+            profilefile.write(line)
+    profilefile.write('\n')
+
+
+def summarise(overhead_file: str, summary_file: str = None):
+    '''
+    summarise adds up the phases and processes recorded by the functions of define_functions, and writes how much
+    time and CPU the profiling cost compared to the work into a JSON file.
+
+    Parameters
+    ----------
+    overhead_file: str = path to the JSON lines file written by the profile script.
+    summary_file: str = path of the JSON file to write, defaults to overhead_file with the extension .json.
+
+    Returns
+    -------
+    dict of the summary
+    '''
+    if summary_file is None:
+        summary_file = overhead_file.rsplit('.', 1)[0] + '.json'
+    phases, daemons = {}, {}
+    with open(overhead_file, 'r') as read_file:
+        for line in read_file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                print(f"Skipping the incomplete overhead record: {line.strip()}")
+                continue
+            if 'phase' in record:
+                phase = phases.setdefault(record['phase'], {'wall_seconds': 0.0, 'cpu_seconds': 0.0})
+                phase['wall_seconds'] += record['end'] - record['start']
+                phase['cpu_seconds'] += record['cpu_seconds']
+            else:
+                daemons[record['daemon']] = {'cpu_seconds': record['cpu_seconds'],
+                                             'peak_memory_GB': record['peak_rss_kB'] / 1e6}
+
+    work_seconds = phases['work']['wall_seconds'] if 'work' in phases else 0.0
+    profiling = [phase for name, phase in phases.items() if name.startswith(profiling_phase_prefixes)]
+    profiling_seconds = sum(phase['wall_seconds'] for phase in profiling)
+    daemon_cpu_seconds = sum(daemon['cpu_seconds'] for daemon in daemons.values())
+    summary = {'work_seconds': work_seconds,
+               'profiling_seconds': profiling_seconds,
+               # Includes the background processes, as their CPU time is added to the phase they are stopped in
+               'profiling_cpu_seconds': sum(phase['cpu_seconds'] for phase in profiling),
+               'profiling_percent': 100 * profiling_seconds / work_seconds if work_seconds > 0 else None,
+               # Mean number of cores the processes running alongside the work kept busy while the work ran
+               'daemon_cores': daemon_cpu_seconds / work_seconds if work_seconds > 0 else None,
+               'daemon_peak_memory_GB': sum(daemon['peak_memory_GB'] for daemon in daemons.values()),
+               'phases': phases,
+               'daemons': daemons}
+    with open(summary_file, 'w') as write_file:
+        json.dump(summary, write_file, indent=4)
+    print(f"Profiling took {profiling_seconds:.1f}s next to {work_seconds:.1f}s of work, and its background "
+          f"processes used {daemon_cpu_seconds:.1f}s of CPU time. Details are in {summary_file}")
+    return summary
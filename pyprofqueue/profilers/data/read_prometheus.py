@@ -1,13 +1,29 @@
 # Built in Modules
-from time import strftime, localtime
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from collections import deque
+import itertools
 import argparse
+import os
 
 # External packages
 from promql_http_api import PromqlHttpApi
+from promql_http_api.api_response import ApiResponse
+from requests.adapters import HTTPAdapter
+import pyarrow as pa
 import pandas as pd
 import numpy as np
 
+# Version of the layout of the written feather files, stored in their schema metadata. Version 1 files, which have no
+# version entry, store Time as local time strings; from version 2 onwards Time is a UTC timestamp column.
+file_format_version = 2
+
+# orjson is optional, it only makes decoding the query responses of long jobs faster
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 parser = argparse.ArgumentParser(description="Just an example")
 parser.add_argument("-o", "--output", type=str, help="output path where data should be stored")
 parser.add_argument("-s", "--start_time", type=str, help="start time of the code")
@@ -15,7 +31,66 @@ parser.add_argument("-e", "--end_time", type=str, help="end time of the code")
 parser.add_argument("-i", "--ip_address", type=str, default="http://localhost:9090",
                     help="IP address of the Prometheus instance")
 parser.add_argument("-a", "--store_all", action='store_true', help="store all data from the database")
-args = parser.parse_args()
+parser.add_argument("-w", "--workers", type=int, default=8,
+                    help="number of queries that are sent to the Prometheus instance at the same time")
+parser.add_argument("-j", "--join", type=str, default='outer', choices=['outer', 'inner'],
+                    help="keep every time stamp (outer) or only those all series have samples for (inner)")
+parser.add_argument("-f", "--fill", type=str, default=None, choices=['ffill', 'interpolate'],
+                    help="how samples missing from a series are filled when using an outer join")
+parser.add_argument("-c", "--chunk_points", type=int, default=10000,
+                    help="maximum samples per series requested in one query, Prometheus refuses more than 11,000")
+parser.add_argument("-t", "--step", type=str, default=None,
+                    help="resolution of the scrape, i.e. '10s', or 'auto' to derive it from the job duration and "
+                         "--points. Defaults to 10s, or 5s with --store_all")
+parser.add_argument("-p", "--points", type=int, default=5000,
+                    help="target number of samples per series when --step is 'auto'")
+parser.add_argument("-m", "--min_step", type=str, default='10s',
+                    help="smallest step --step 'auto' may choose, should not be below the scrape interval")
+parser.add_argument("-v", "--overview", type=int, default=0,
+                    help="if above 0, additionally write a downsampled overview file with about this many samples "
+                         "per series")
+parser.add_argument("-n", "--nodes", action='store_true',
+                    help="name each series after the node it was scraped from, and add totals over all nodes")
+args = None
+
+# Queries scraped when --store_all is not given. Each entry is passed on to prometheus_scrape, so new metrics only
+# have to be added here. Column names are given_name, followed by the value of the name_convention label if one is set.
+node_queries = [
+    {'given_name': 'CPU Usage:', 'name_convention': 'cpu',
+     'command': '100 - irate(node_cpu_seconds_total{mode="idle"}[1m])*100'},
+    {'given_name': 'CPU IO Wait:', 'name_convention': 'cpu',
+     'command': 'irate(node_cpu_seconds_total{mode="iowait"}[1m])*100'},
+    {'given_name': 'Memory Total [GB]',
+     'command': '(node_memory_MemTotal_bytes)/(1000000000)'},
+    {'given_name': 'Memory Usage [GB]',
+     'command': '(node_memory_MemTotal_bytes-node_memory_MemAvailable_bytes)/(1000000000)'},
+    {'given_name': 'Write:', 'name_convention': 'device',
+     'command': '(irate(node_disk_written_bytes_total[1m]))/(1000000000)'},
+    {'given_name': 'Read:', 'name_convention': 'device',
+     'command': '(irate(node_disk_read_bytes_total[1m]))/(1000000000)'},
+    {'given_name': 'Received:', 'name_convention': 'device',
+     'command': 'irate(node_network_receive_bytes_total[1m])/1e3'},
+    {'given_name': 'Sent:', 'name_convention': 'device',
+     'command': 'irate(node_network_transmit_bytes_total[1m])/1e3'},
+]
+# Queries added with --nodes, which combine the series of all nodes. The memory totals keep the names of the single
+# node columns, so the memory plot shows the memory of the whole job.
+node_total_queries = [
+    {'given_name': 'Mean CPU Usage [%]',
+     'command': '100 - avg(irate(node_cpu_seconds_total{mode="idle"}[1m]))*100'},
+    {'given_name': 'Memory Total [GB]',
+     'command': 'sum(node_memory_MemTotal_bytes)/(1000000000)'},
+    {'given_name': 'Memory Usage [GB]',
+     'command': 'sum(node_memory_MemTotal_bytes-node_memory_MemAvailable_bytes)/(1000000000)'},
+    {'given_name': 'Total Write [GB/s]',
+     'command': 'sum(irate(node_disk_written_bytes_total[1m]))/(1000000000)'},
+    {'given_name': 'Total Read [GB/s]',
+     'command': 'sum(irate(node_disk_read_bytes_total[1m]))/(1000000000)'},
+    {'given_name': 'Total Received [kB/s]',
+     'command': 'sum(irate(node_network_receive_bytes_total[1m]))/1e3'},
+    {'given_name': 'Total Sent [kB/s]',
+     'command': 'sum(irate(node_network_transmit_bytes_total[1m]))/1e3'},
+]
 
 
 def check_options():
@@ -42,36 +117,323 @@ def check_options():
     return start_time, end_time
 
 
+def query_range_results(connection: PromqlHttpApi, command: str, begin: datetime, end: datetime, step: str):
+    """
+    query_range_results sends a query_range request to the Prometheus instance and decodes the JSON response a single
+    time, rather than once per access as PromqlHttpApi does.
+
+    Parameters
+    ----------
+    connection: PromqlHttpApi = connection to the Prometheus instance.
+    command: str = PromQL query to evaluate.
+    begin: datetime = start of the range to scrape.
+    end: datetime = end of the range to scrape.
+    step: str = resolution of the range query, i.e. '10s'.
+
+    Returns
+    -------
+    list of the series of the Prometheus matrix result
+    """
+    query = connection.query_range(command, start=begin, end=end, step=step)
+    response = ApiResponse(connection.url + query.make_url(), headers=connection.headers).response
+    body = json_loads(response.content)
+    if body['status'] != 'success':
+        exit(f"Prometheus query '{command}' failed with: {body.get('error')}")
+    return body['data']['result']
+
+
+def decode_matrix(results: list, key_names: list):
+    """
+    decode_matrix converts all series of a Prometheus matrix result into one flat float buffer in a single pass, and
+    returns a [time, value] view of that buffer for every series.
+
+    Parameters
+    ----------
+    results: list = series of the Prometheus matrix result, as returned by query_range_results.
+    key_names: list = names to give each series, in the same order as results.
+
+    Returns
+    -------
+    dict of series names to numpy arrays of [time, value] pairs
+    """
+    lengths = np.fromiter((len(result['values']) for result in results), dtype=np.int64, count=len(results))
+    samples = np.fromiter(itertools.chain.from_iterable(itertools.chain.from_iterable(
+        result['values'] for result in results)), dtype=object, count=2 * int(lengths.sum()))
+    buffer = samples.astype(np.float64).reshape(-1, 2)
+    bounds = np.concatenate(([0], np.cumsum(lengths)))
+    return {key_name: buffer[bounds[number]:bounds[number + 1]] for number, key_name in enumerate(key_names)}
+
+
+def node_name(metric: dict):
+    # Host name of the node a series was scraped from, i.e. 'node01' for the instance 'node01:9303'
+    return metric['instance'].rsplit(':', 1)[0]
+
+
 def prometheus_scrape(connection: PromqlHttpApi, command: str, begin: datetime, end: datetime,
-                      given_name: str, name_convention: str = None, step: str = '10s'):
-    queue_results = connection.query_range(command, start=begin, end=end, step=step)()['result']
-    queue_dict = {}
-    for result in queue_results:
-        if name_convention is not None:
-            key_name = given_name + ' ' + result['metric'][name_convention]
-        else:
-            key_name = given_name
-        queue_dict[key_name] = np.array([[float(x[0]), float(x[1])] for x in result['values']])
-    return queue_dict
+                      given_name: str, name_convention: str = None, step: str = '10s', per_node: bool = False):
+    if step_seconds(step) > 60:
+        # irate only looks at the last two samples in its window, so at coarse steps it would sample single spikes.
+        # rate over a full step averages everything between two returned samples instead.
+        command = command.replace('irate(', 'rate(').replace('[1m]', f'[{step}]')
+    queue_results = query_range_results(connection, command, begin, end, step)
+    if name_convention is not None and per_node:
+        key_names = [given_name + ' ' + node_name(result['metric']) + '/' + result['metric'][name_convention]
+                     for result in queue_results]
+    elif name_convention is not None:
+        key_names = [given_name + ' ' + result['metric'][name_convention] for result in queue_results]
+    elif per_node:
+        key_names = [given_name + ' ' + node_name(result['metric']) for result in queue_results]
+    else:
+        key_names = [given_name] * len(queue_results)
+    return decode_matrix(queue_results, key_names)
+
+
+def step_seconds(step: str):
+    """
+    step_seconds converts a Prometheus duration such as '10s', '5m' or '1h' into seconds.
+    """
+    units = {'ms': 1e-3, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    for unit in sorted(units, key=len, reverse=True):
+        if step.endswith(unit) and step[:-len(unit)].replace('.', '', 1).isdigit():
+            return float(step[:-len(unit)]) * units[unit]
+    exit(f"step {step} is not a duration Prometheus understands, i.e. '10s'.")
+
+
+def choose_step(begin: datetime, end: datetime, points: int, min_step: str = '10s'):
+    """
+    choose_step picks the smallest step from a list of round durations that keeps the samples per series between
+    begin and end within points, but never goes below min_step.
+
+    Returns
+    -------
+    str of the step, i.e. '30s'
+    """
+    duration = (end - begin).total_seconds()
+    target = max(duration / max(points - 1, 1), step_seconds(min_step))
+    for step in [1, 2, 5, 10, 15, 30, 60, 120, 300, 600, 900, 1800, 3600, 7200, 21600, 43200, 86400]:
+        if step >= target:
+            return f'{step}s'
+    return f'{int(np.ceil(target))}s'
+
+
+def time_chunks(begin: datetime, end: datetime, step: str, chunk_points: int):
+    """
+    time_chunks splits the range [begin, end] into consecutive windows that hold at most chunk_points samples per
+    series at the given step. Windows do not overlap, so no time stamp is scraped twice.
+
+    Returns
+    -------
+    list of (begin, end) tuples of datetimes
+    """
+    step_size = timedelta(seconds=step_seconds(step))
+    chunk_size = step_size * (max(chunk_points, 1) - 1)
+    chunks = []
+    chunk_begin = begin
+    while chunk_begin <= end:
+        chunk_end = min(chunk_begin + chunk_size, end)
+        chunks.append((chunk_begin, chunk_end))
+        chunk_begin = chunk_end + step_size
+    return chunks
 
 
-def prometheus_scrape_all(connection: PromqlHttpApi, begin: datetime, end: datetime, step: str = '5s'):
-    queue_results = connection.query_range('{job!=""}', start=begin, end=end, step=step)()['result']
+def prometheus_scrape_batch(connection: PromqlHttpApi, queries: list, begin: datetime, end: datetime,
+                            step: str = '10s', workers: int = 8, chunk_points: int = 10000,
+                            scrape=None):
+    """
+    prometheus_scrape_batch splits [begin, end] into windows of at most chunk_points samples per series and sends
+    every query for every window to the Prometheus instance concurrently. Windows are yielded one at a time and in
+    order, with only a few windows being fetched ahead, so memory use is bounded by the window size rather than the
+    length of the job.
+
+    Parameters
+    ----------
+    connection: PromqlHttpApi = connection to the Prometheus instance.
+    queries: list = list of dictionaries containing the keyword arguments of scrape for each query.
+    begin: datetime = start of the range to scrape.
+    end: datetime = end of the range to scrape.
+    step: str = resolution of the range queries, i.e. '10s'.
+    workers: int = maximum number of queries in flight at once.
+    chunk_points: int = maximum number of samples per series requested in a single query.
+    scrape: function = function used for each query, defaults to prometheus_scrape.
+
+    Returns
+    -------
+    generator of dictionaries of series names to numpy arrays of [time, value] pairs, one per window
+    """
+    if scrape is None:
+        scrape = prometheus_scrape
+    workers = max(workers, 1)
+    # PromqlHttpApi shares a single requests.Session between all calls, so widening its connection pool lets every
+    # worker thread keep its connection to Prometheus alive instead of reconnecting per query.
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+    ApiResponse.session.mount('http://', adapter)
+    ApiResponse.session.mount('https://', adapter)
+    windows_ahead = max(1, -(-workers // max(len(queries), 1)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for chunk_begin, chunk_end in time_chunks(begin, end, step, chunk_points):
+            pending.append([executor.submit(scrape, connection=connection, begin=chunk_begin, end=chunk_end,
+                                            step=step, **query) for query in queries])
+            if len(pending) > windows_ahead:
+                yield collect_window(pending.popleft())
+        while pending:
+            yield collect_window(pending.popleft())
+
+
+def collect_window(futures: list):
     queue_dict = {}
-    for result in queue_results:
-        key_name = result['metric']['job'] + '=' + result['metric']['__name__']
-        queue_dict[key_name] = np.array([[float(x[0]), float(x[1])] for x in result['values']])
+    for future in futures:
+        queue_dict.update(future.result())
     return queue_dict
 
 
-def pandas_merge(dictionary: dict, dataframe: pd.DataFrame = None):
-    for key in dictionary.keys():
-        if dataframe is None:
-            dataframe = pd.DataFrame({'Time': dictionary[key][:, 0], key: dictionary[key][:, 1]})
-        else:
-            dataframe = pd.merge(dataframe, pd.DataFrame({'Time': dictionary[key][:, 0],
-                                                          key: dictionary[key][:, 1]}), on='Time')
-    return dataframe
+def write_feather(windows, output_file: str, join: str = 'outer', fill: str = None,
+                  overview_file: str = None, overview_seconds: float = None):
+    """
+    write_feather builds a DataFrame for each scraped window and appends it to output_file as a record batch of a
+    single feather file, so that only one window is held in memory at a time. Series that first appear in a later
+    window are added as columns of the file, holding no values for the windows before.
+
+    Parameters
+    ----------
+    windows: iterable = dictionaries of series names to numpy arrays of [time, value] pairs, one per window.
+    output_file: str = path of the feather file to write.
+    join: str = join used by pandas_merge within each window.
+    fill: str = fill used by pandas_merge within each window.
+    overview_file: str = optional path of a second feather file, holding the mean of every overview_seconds.
+    overview_seconds: float = length of the time bins averaged into overview_file.
+
+    Returns
+    -------
+    dict with the 'series' names that were missing samples in any window, the number of 'time_stamps' scraped and
+    how many of them were 'dropped' by an inner join, summed over all windows
+    """
+    writers = {}
+    origin = None
+    gaps = {'series': set(), 'time_stamps': 0, 'dropped': 0}
+    try:
+        for window in windows:
+            window_df, window_gaps = pandas_merge(dictionary=window, join=join, fill=fill)
+            gaps['series'].update(window_gaps['series'])
+            gaps['time_stamps'] += window_gaps['time_stamps']
+            gaps['dropped'] += window_gaps['dropped']
+            if window_df is None:
+                continue
+            if overview_file is not None:
+                if origin is None:
+                    origin = window_df['Time'].iloc[0]
+                time_bin = np.floor((window_df['Time'].values - origin) / overview_seconds)
+                overview_df = window_df.groupby(time_bin, sort=True).mean()
+                overview_df['Time'] = origin + overview_df.index.values * overview_seconds
+                append_batch(writers, overview_file, overview_df.reset_index(drop=True))
+            append_batch(writers, output_file, window_df)
+    finally:
+        for writer, _ in writers.values():
+            writer.close()
+    if output_file not in writers:
+        exit("Prometheus returned no data between the start and end time.")
+    return gaps
+
+
+def append_batch(writers: dict, output_file: str, dataframe: pd.DataFrame):
+    # Opens output_file on the first call. The file is left uncompressed so that it can be memory mapped and read
+    # without copying.
+    dataframe['Time'] = pd.to_datetime(dataframe['Time'], unit='s', utc=True)
+    if output_file not in writers:
+        schema = pa.Schema.from_pandas(dataframe, preserve_index=False)
+        schema = schema.with_metadata(schema.metadata | {b'pyprofqueue_format': str(file_format_version).encode()})
+        writers[output_file] = (pa.ipc.new_file(output_file, schema), schema)
+    writer, schema = writers[output_file]
+    extra = [column for column in dataframe.columns if column not in schema.names]
+    if len(extra) > 0:
+        new_schema = pa.Schema.from_pandas(dataframe[extra], preserve_index=False)
+        schema = pa.schema(list(schema) + list(new_schema), metadata=schema.metadata)
+        writers[output_file] = (widen_file(writer, output_file, schema), schema)
+        writer = writers[output_file][0]
+    dataframe = dataframe.reindex(columns=schema.names)
+    writer.write_batch(pa.RecordBatch.from_pandas(dataframe, schema=schema, preserve_index=False))
+
+
+def widen_file(writer: pa.ipc.RecordBatchFileWriter, output_file: str, schema: pa.Schema):
+    # A feather file holds a single schema, so the batches written so far are copied into a file with the new schema,
+    # with the new columns holding nulls. This only happens when series first appear after the first window.
+    writer.close()
+    new_writer = pa.ipc.new_file(output_file + '.tmp', schema)
+    with pa.memory_map(output_file) as source:
+        reader = pa.ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            columns = [batch.column(field.name) if field.name in batch.schema.names else
+                       pa.nulls(batch.num_rows, type=field.type) for field in schema]
+            new_writer.write_batch(pa.RecordBatch.from_arrays(columns, schema=schema))
+    os.replace(output_file + '.tmp', output_file)
+    return new_writer
+
+
+def prometheus_scrape_all(connection: PromqlHttpApi, begin: datetime, end: datetime, step: str = '5s',
+                          per_node: bool = False):
+    queue_results = query_range_results(connection, '{job!=""}', begin, end, step)
+    key_names = [result['metric']['job'] + '=' + result['metric']['__name__'] for result in queue_results]
+    if per_node:
+        key_names = [key_name + ' ' + node_name(result['metric']) for key_name, result in zip(key_names, queue_results)]
+    return decode_matrix(queue_results, key_names)
+
+
+def pandas_merge(dictionary: dict, dataframe: pd.DataFrame = None, join: str = 'outer', fill: str = None):
+    """
+    pandas_merge aligns every series in dictionary on one shared time index and builds the wide DataFrame in a single
+    allocation, rather than merging the series into the DataFrame one at a time.
+
+    Parameters
+    ----------
+    dictionary: dict = series names to numpy arrays of [time, value] pairs.
+    dataframe: pd.DataFrame = optional existing DataFrame with a 'Time' column that the series are joined onto.
+    join: str = 'outer' keeps every time stamp seen by any series, 'inner' only keeps the time stamps every series
+        has a sample for.
+    fill: str = how samples missing from a series are filled when join is 'outer'. None leaves them as NaN, 'ffill'
+        carries the previous sample forward and 'interpolate' interpolates linearly in time.
+
+    Returns
+    -------
+    pd.DataFrame with a 'Time' column followed by one column per series, and a dict with the 'series' names that are
+    missing samples, the number of 'time_stamps' seen by any series and how many of them were 'dropped' by an inner
+    join
+    """
+    if join not in ['outer', 'inner']:
+        exit(f"join must be either 'outer' or 'inner', {join} was given.")
+    if fill not in [None, 'ffill', 'interpolate']:
+        exit(f"fill must be either None, 'ffill' or 'interpolate', {fill} was given.")
+    keys = list(dictionary.keys())
+    gaps = {'series': [], 'time_stamps': 0, 'dropped': 0}
+    if len(keys) == 0:
+        return dataframe, gaps
+
+    lengths = np.array([len(dictionary[key]) for key in keys])
+    samples = np.concatenate([dictionary[key] for key in keys])
+    time_index, rows = np.unique(samples[:, 0], return_inverse=True)
+    columns = np.repeat(np.arange(len(keys)), lengths)
+    values = np.full((len(time_index), len(keys)), np.nan)
+    values[rows, columns] = samples[:, 1]
+
+    missing = len(time_index) - lengths
+    gaps['time_stamps'] = len(time_index)
+    if missing.any():
+        gaps['series'] = [key for key, count in zip(keys, missing) if count > 0]
+        if join == 'inner':
+            complete = np.bincount(rows, minlength=len(time_index)) == len(keys)
+            gaps['dropped'] = len(time_index) - np.count_nonzero(complete)
+            time_index, values = time_index[complete], values[complete]
+
+    wide_frame = pd.DataFrame(values, columns=keys, copy=False)
+    if join == 'outer' and fill == 'ffill':
+        wide_frame = wide_frame.ffill()
+    elif join == 'outer' and fill == 'interpolate':
+        wide_frame = wide_frame.set_index(time_index).interpolate(method='index', limit_area='inside')
+        wide_frame = wide_frame.reset_index(drop=True)
+    wide_frame.insert(0, 'Time', time_index)
+    if dataframe is not None:
+        wide_frame = pd.merge(dataframe, wide_frame, on='Time', how=join)
+    return wide_frame, gaps
 
 
 def main():
@@ -79,65 +441,42 @@ def main():
     api = PromqlHttpApi(args.ip_address)
     start_time, end_time = check_options()
     if args.store_all:
-        full_scrape_dict = prometheus_scrape_all(connection=api,
-                                                 begin=start_time, end=end_time)
-        Full_df = pandas_merge(dictionary=full_scrape_dict)
-        Full_df['Time'] = Full_df['Time'].apply(lambda x: strftime('%Y-%m-%d %H:%M:%S', localtime(x)))
-
-        Full_df.to_feather(args.output + '/full_prometheus_data.ft')
+        queries, scrape, step, name = [{}], prometheus_scrape_all, '5s', 'full_prometheus_data'
     else:
-        cpu_usage_dict = prometheus_scrape(connection=api,
-                                           command='100 - irate(node_cpu_seconds_total{mode="idle"}[1m])*100',
-                                           begin=start_time, end=end_time,
-                                           given_name='CPU Usage:', name_convention='cpu')
-        Full_df = pandas_merge(dictionary=cpu_usage_dict)
-        cpu_iowait_dict = prometheus_scrape(connection=api,
-                                            command='irate(node_cpu_seconds_total{mode="iowait"}[1m])*100',
-                                            begin=start_time, end=end_time,
-                                            given_name='CPU IO Wait:', name_convention='cpu')
-        Full_df = pandas_merge(dictionary=cpu_iowait_dict, dataframe=Full_df)
-
-        max_memory_dict = prometheus_scrape(connection=api,
-                                        command='(node_memory_MemTotal_bytes)/(1000000000)',
-                                        begin=start_time, end=end_time,
-                                        given_name='Memory Total [GB]')
-        Full_df = pandas_merge(dictionary=max_memory_dict, dataframe=Full_df)
-
-        memory_dict = prometheus_scrape(connection=api,
-                                        command='(node_memory_MemTotal_bytes-node_memory_MemAvailable_bytes)/(1000000000)',
-                                        begin=start_time, end=end_time,
-                                        given_name='Memory Usage [GB]')
-        Full_df = pandas_merge(dictionary=memory_dict, dataframe=Full_df)
-
-        disk_write_dict = prometheus_scrape(connection=api,
-                                            command='(irate(node_disk_written_bytes_total[1m]))/(1000000000)',
-                                            begin=start_time, end=end_time,
-                                            given_name='Write:', name_convention='device')
-        Full_df = pandas_merge(dictionary=disk_write_dict, dataframe=Full_df)
-
-        disk_read_dict = prometheus_scrape(connection=api,
-                                           command='(irate(node_disk_read_bytes_total[1m]))/(1000000000)',
-                                           begin=start_time, end=end_time,
-                                           given_name='Read:', name_convention='device')
-        Full_df = pandas_merge(dictionary=disk_read_dict, dataframe=Full_df)
-
-        network_receive_KB_dict = prometheus_scrape(connection=api,
-                                                    command='irate(node_network_receive_bytes_total[1m])/1e3',
-                                                    begin=start_time, end=end_time,
-                                                    given_name='Received:', name_convention='device')
-        Full_df = pandas_merge(dictionary=network_receive_KB_dict, dataframe=Full_df)
-
-        network_send_KB_dict = prometheus_scrape(connection=api,
-                                                 command='irate(node_network_transmit_bytes_total[1m])/1e3',
-                                                 begin=start_time, end=end_time,
-                                                 given_name='Sent:', name_convention='device')
-        Full_df = pandas_merge(dictionary=network_send_KB_dict, dataframe=Full_df)
-
-        Full_df['Time'] = Full_df['Time'].apply(lambda x: strftime('%Y-%m-%d %H:%M:%S', localtime(x)))
-
-        Full_df.to_feather(args.output + '/prometheus_data.ft')
+        queries, scrape, step, name = node_queries, prometheus_scrape, '10s', 'prometheus_data'
+    if args.nodes:
+        queries = [query | {'per_node': True} for query in queries]
+        if not args.store_all:
+            queries += node_total_queries
+    if args.step == 'auto':
+        step = choose_step(start_time, end_time, args.points, args.min_step)
+    elif args.step is not None:
+        step = args.step
+
+    chunk_points = args.chunk_points
+    overview_file, overview_seconds = None, None
+    if args.overview > 0:
+        overview_file = args.output + '/' + name + '_overview.ft'
+        overview_steps = max(1, int(np.ceil((end_time - start_time).total_seconds() /
+                                            max(args.overview - 1, 1) / step_seconds(step))))
+        # Windows hold a whole number of overview bins, so no bin is split between two windows
+        overview_steps = min(overview_steps, chunk_points)
+        chunk_points = chunk_points // overview_steps * overview_steps
+        overview_seconds = overview_steps * step_seconds(step)
 
+    windows = prometheus_scrape_batch(connection=api, queries=queries, begin=start_time, end=end_time, step=step,
+                                      workers=args.workers, chunk_points=chunk_points, scrape=scrape)
+    gaps = write_feather(windows, args.output + '/' + name + '.ft', join=args.join, fill=args.fill,
+                         overview_file=overview_file, overview_seconds=overview_seconds)
+    if len(gaps['series']) > 0:
+        if args.join == 'inner':
+            print(f"{len(gaps['series'])} series are missing samples, dropping {gaps['dropped']} of "
+                  f"{gaps['time_stamps']} time stamps.")
+        else:
+            print(f"{len(gaps['series'])} series are missing samples, "
+                  f"{'left as NaN' if args.fill is None else 'filled using ' + args.fill}.")
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    args = parser.parse_args()
+    main()
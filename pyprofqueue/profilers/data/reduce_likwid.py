@@ -0,0 +1,222 @@
+# Built in Modules
+import argparse
+import signal
+import time
+import sys
+import os
+
+# External packages
+import pyarrow as pa
+import numpy as np
+
+parser = argparse.ArgumentParser(description="Reads the stderr of likwid-perfctr -t from stdin while the work runs, "
+                                             "and writes the samples of its timeline as Arrow records along with "
+                                             "rolling aggregates of a bounded size. Lines that are not samples, i.e. "
+                                             "the stderr of the work itself, are passed on to stderr and the first "
+                                             "of them are written to a passthrough file.")
+parser.add_argument("-o", "--output", type=str, help="output path where data should be stored")
+parser.add_argument("-f", "--flush", type=float, default=600,
+                    help="seconds after which the samples read are written, a reducer that is killed loses at most "
+                         "the samples of this long")
+parser.add_argument("-r", "--region", type=int, default=None,
+                    help="number of the profiled code line, which is added to the names of the files written")
+parser.add_argument("-w", "--windows", type=int, default=512,
+                    help="maximum number of windows of the rolling aggregates, adjacent windows are merged once "
+                         "there are more")
+parser.add_argument("-p", "--passthrough-limit", type=float, default=64,
+                    help="MB of the passthrough file, later lines only reach stderr")
+args = None
+
+timeline_name = 'likwid_timeline.arrow'
+aggregates_name = 'likwid_aggregates.arrow'
+passthrough_name = 'likwid_stderr.txt'
+
+
+def region_name(name: str, region: int = None):
+    # The files of the Nth profiled code line get _N before their extension, i.e. likwid_timeline_0.arrow
+    if region is None:
+        return name
+    stem, extension = name.rsplit('.', 1)
+    return f'{stem}_{region}.{extension}'
+
+
+class Stop(Exception):
+    pass
+
+
+def stop(signum, frame):
+    raise Stop
+
+
+def parse_sample(line: str):
+    """
+    parse_sample reads one line of the likwid timeline, which holds GID, MetricsCount, CpuCount and the runtime,
+    followed by every thread of the first metric, then every thread of the second metric and so on.
+
+    Returns
+    -------
+    tuple of the metric count, the cpu count and np.array of float64 with the runtime followed by the values, or None
+    if the line is not a sample
+    """
+    fields = line.split(',')
+    try:
+        metric_count, cpu_count = int(fields[1]), int(fields[2])
+        if len(fields) != 4 + metric_count * cpu_count:
+            return None
+        int(fields[0])
+        return metric_count, cpu_count, np.array(fields[3:], dtype=np.float64)
+    except (IndexError, ValueError):
+        return None
+
+
+class RollingAggregates:
+    """
+    Mean, minimum and maximum of every value of the timeline over windows of samples. There are never more than
+    max_windows windows, once there are more every two adjacent windows are merged into one, and the windows that
+    follow hold twice as many samples. Long jobs thereby get coarser windows instead of a larger file.
+
+    Parameters to initiate
+    ----------
+    width: int = number of values of a sample, including the runtime.
+    max_windows: int = maximum number of windows kept.
+    """
+    def __init__(self, width: int, max_windows: int):
+        self.max_windows = max(2, max_windows - max_windows % 2)
+        self.window_samples = 1
+        self.samples = 0
+        # Start and end runtime, sample count, sum, minimum and maximum of each window
+        self.bounds = np.zeros((self.max_windows + 1, 2))
+        self.counts = np.zeros(self.max_windows + 1)
+        self.sums = np.zeros((self.max_windows + 1, width - 1))
+        self.minimums = np.zeros((self.max_windows + 1, width - 1))
+        self.maximums = np.zeros((self.max_windows + 1, width - 1))
+        self.windows = 0
+
+    def add(self, record: np.array):
+        runtime, values = record[0], record[1:]
+        self.samples += 1
+        last = self.windows - 1
+        if self.windows == 0 or self.counts[last] >= self.window_samples:
+            last = self.windows
+            self.windows += 1
+            self.bounds[last] = runtime
+            self.counts[last] = 0
+            self.sums[last] = 0
+            self.minimums[last] = values
+            self.maximums[last] = values
+        self.bounds[last, 1] = runtime
+        self.counts[last] += 1
+        self.sums[last] += values
+        self.minimums[last] = np.fmin(self.minimums[last], values)
+        self.maximums[last] = np.fmax(self.maximums[last], values)
+        if self.windows > self.max_windows:
+            self.merge()
+
+    def merge(self):
+        # Only called right after a new window was opened with the one sample that made max_windows + 1 windows. The
+        # max_windows full windows before it, an even number, are merged pairwise and the new window follows them.
+        full = self.windows - 1
+        half = full // 2
+        self.bounds[:half] = np.stack([self.bounds[0:full:2, 0], self.bounds[1:full:2, 1]], axis=1)
+        self.counts[:half] = self.counts[0:full:2] + self.counts[1:full:2]
+        self.sums[:half] = self.sums[0:full:2] + self.sums[1:full:2]
+        self.minimums[:half] = np.fmin(self.minimums[0:full:2], self.minimums[1:full:2])
+        self.maximums[:half] = np.fmax(self.maximums[0:full:2], self.maximums[1:full:2])
+        for array in [self.bounds, self.counts, self.sums, self.minimums, self.maximums]:
+            array[half] = array[full]
+        self.windows = half + 1
+        self.window_samples *= 2
+
+    def to_table(self, metric_count: int, cpu_count: int):
+        windows = self.windows
+        columns = {'Start': self.bounds[:windows, 0], 'End': self.bounds[:windows, 1],
+                   'Samples': self.counts[:windows]}
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means = self.sums[:windows] / self.counts[:windows, None]
+        for column in range(self.sums.shape[1]):
+            columns[f'Mean {column}'] = means[:, column]
+            columns[f'Min {column}'] = self.minimums[:windows, column]
+            columns[f'Max {column}'] = self.maximums[:windows, column]
+        table = pa.table(columns)
+        # window_samples tells readers whether the windows are coarser than the timeline itself
+        return table.replace_schema_metadata(timeline_metadata(metric_count, cpu_count) |
+                                             {b'window_samples': str(self.window_samples).encode(),
+                                              b'samples': str(self.samples).encode()})
+
+    def write(self, aggregates_file: str, metric_count: int, cpu_count: int):
+        table = self.to_table(metric_count, cpu_count)
+        # Written under a temporary name and renamed, so an aggregates file is always complete
+        with pa.ipc.new_file(aggregates_file + '.tmp', table.schema) as aggregates_writer:
+            aggregates_writer.write_table(table)
+        os.replace(aggregates_file + '.tmp', aggregates_file)
+
+
+def timeline_metadata(metric_count: int, cpu_count: int):
+    return {b'metrics_count': str(metric_count).encode(), b'cpu_count': str(cpu_count).encode()}
+
+
+def write_samples(writer: pa.ipc.RecordBatchStreamWriter, schema: pa.Schema, samples: list):
+    if len(samples) == 0:
+        return
+    records = np.stack(samples)
+    # The timeline is an unbuffered OSFile, so the samples written survive the reducer being killed
+    writer.write_batch(pa.record_batch([records[:, column] for column in range(records.shape[1])], schema=schema))
+
+
+def reduce(stream, output: str, flush: float, max_windows: int, region: int = None, passthrough_limit: float = 64):
+    timeline_file = output + '/' + region_name(timeline_name, region)
+    aggregates_file = output + '/' + region_name(aggregates_name, region)
+    writer, aggregates, counts = None, None, None
+    # Bytes left of the passthrough file, which is a copy of what reaches stderr and so need not grow with the job
+    passthrough_left = passthrough_limit * 1e6
+    # Samples not written yet, they are written together as each record batch holds metadata for every column
+    pending, last_flush = [], time.time()
+    signal.signal(signal.SIGTERM, stop)
+    with open(output + '/' + region_name(passthrough_name, region), 'w') as passthrough:
+        try:
+            for line in stream:
+                sample = parse_sample(line.strip())
+                if sample is None or (counts is not None and sample[:2] != counts):
+                    # The stderr of the work still reaches the stderr of the job, as it would without likwid
+                    sys.stderr.write(line)
+                    sys.stderr.flush()
+                    if passthrough_left > 0:
+                        passthrough_left -= len(line)
+                        passthrough.write(line if passthrough_left > 0 else
+                                          f"Stopped copying stderr after {passthrough_limit} MB.\n")
+                        passthrough.flush()
+                    continue
+                if writer is None:
+                    counts = sample[:2]
+                    schema = pa.schema([('Runtime', pa.float64())] +
+                                       [(str(column), pa.float64()) for column in range(len(sample[2]) - 1)],
+                                       metadata=timeline_metadata(*counts))
+                    timeline = pa.OSFile(timeline_file, 'wb')
+                    writer = pa.ipc.new_stream(timeline, schema, options=pa.ipc.IpcWriteOptions(compression='zstd'))
+                    aggregates = RollingAggregates(len(sample[2]), max_windows)
+                pending += [sample[2]]
+                aggregates.add(sample[2])
+                if time.time() - last_flush >= flush:
+                    write_samples(writer, schema, pending)
+                    aggregates.write(aggregates_file, *counts)
+                    pending, last_flush = [], time.time()
+        except (Stop, KeyboardInterrupt):
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    if writer is None:
+        print(f"No likwid samples were read, so {timeline_file} was not written.", file=sys.stderr)
+        return
+    write_samples(writer, schema, pending)
+    writer.close()
+    timeline.close()
+    aggregates.write(aggregates_file, *counts)
+
+
+def main():
+    if args.output is None:
+        exit("output is required")
+    reduce(sys.stdin, args.output, args.flush, args.windows, args.region, args.passthrough_limit)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main()
@@ -0,0 +1,433 @@
+# Built in Modules
+import argparse
+import signal
+import json
+import time
+import os
+import re
+
+# External packages
+import pyarrow as pa
+import pandas as pd
+import numpy as np
+
+# Same layout version as the files written by read_prometheus.py, so both are read by the same loaders
+file_format_version = 2
+layout_version = 1
+
+parser = argparse.ArgumentParser(description="Samples /proc until terminated, then writes the samples in the layout "
+                                             "of the prometheus data. With --tree only the processes started by the "
+                                             "given process are sampled.")
+parser.add_argument("-o", "--output", type=str, help="output path where data should be stored")
+parser.add_argument("-i", "--interval", type=float, default=10, help="seconds between two samples")
+parser.add_argument("-c", "--convert", action='store_true',
+                    help="only convert existing samples in the output path, without sampling")
+parser.add_argument("-t", "--tree", type=int, default=None,
+                    help="sample the CPU, memory and IO used by the descendants of this process id")
+parser.add_argument("-x", "--exclude", type=int, nargs='*', default=[],
+                    help="process ids that, along with their descendants, are left out of the --tree samples")
+parser.add_argument("-X", "--exclude-file", type=str, default=None,
+                    help="file of process ids to leave out like --exclude, one per line, which is read again before "
+                         "every sample so processes started after the sampler can be added to it")
+parser.add_argument("-b", "--batch", type=int, default=30,
+                    help="number of samples written to the output path together, a sampler that is killed with "
+                         "SIGKILL loses at most the samples of one batch")
+parser.add_argument("-m", "--merge", type=str, default=None,
+                    help="feather file of prometheus data the process samples in the output path are added to")
+parser.add_argument("-M", "--merge-overview", type=str, default=None,
+                    help="overview feather file of prometheus data the process samples are averaged into, with --merge")
+args = None
+
+# Disks excluded by node_exporter by default, i.e. partitions and ram or loop devices
+excluded_disks = re.compile(r'^(z?ram|loop|fd|(h|s|v|xv)d[a-z]|nvme\d+n\d+p)\d+$')
+sector_bytes = 512
+# Files of the node samples, and of the --tree process samples
+file_prefixes = {False: 'procstat', True: 'process'}
+
+
+class Stop(Exception):
+    pass
+
+
+def stop(signum, frame):
+    raise Stop
+
+
+def read_cpus(stat_file):
+    # Per cpu idle and iowait ticks, the fourth and fifth value of the cpu<N> lines
+    stat_file.seek(0)
+    cpus = {}
+    for line in stat_file.read().splitlines():
+        if line.startswith('cpu') and line[3].isdigit():
+            values = line.split()
+            cpus[values[0][3:]] = (float(values[4]), float(values[5]))
+    return cpus
+
+
+def read_memory(meminfo_file):
+    meminfo_file.seek(0)
+    memory = {}
+    for line in meminfo_file.read().splitlines():
+        name, value = line.split(':', 1)
+        if name in ['MemTotal', 'MemAvailable']:
+            memory[name] = float(value.split()[0]) * 1024
+    return memory['MemTotal'], memory['MemAvailable']
+
+
+def read_disks(diskstats_file):
+    # Bytes written and read per disk, from the sectors written and read
+    diskstats_file.seek(0)
+    disks = {}
+    for line in diskstats_file.read().splitlines():
+        values = line.split()
+        if excluded_disks.match(values[2]) is None:
+            disks[values[2]] = (float(values[9]) * sector_bytes, float(values[5]) * sector_bytes)
+    return disks
+
+
+def read_network(net_file):
+    # Bytes received and sent per interface, the first and ninth value after the interface name
+    net_file.seek(0)
+    interfaces = {}
+    for line in net_file.read().splitlines()[2:]:
+        name, values = line.split(':', 1)
+        values = values.split()
+        interfaces[name.strip()] = (float(values[0]), float(values[8]))
+    return interfaces
+
+
+def open_sources():
+    return {'stat': open('/proc/stat'), 'meminfo': open('/proc/meminfo'),
+            'diskstats': open('/proc/diskstats'), 'net': open('/proc/net/dev')}
+
+
+def sample(sources: dict, layout: dict):
+    """
+    sample reads the current counters from /proc into one fixed width record, in the order given by layout.
+
+    Parameters
+    ----------
+    sources: dict = open /proc files, from open_sources.
+    layout: dict = names of the cpus, disks and network interfaces sampled, as written to the layout file.
+
+    Returns
+    -------
+    np.array of float64 with the time, the idle and iowait ticks of every cpu, the total and available memory, the
+    bytes written and read of every disk and the bytes received and sent of every interface. Devices that disappeared
+    since the layout was made are NaN.
+    """
+    now = time.time()
+    cpus = read_cpus(sources['stat'])
+    memory = read_memory(sources['meminfo'])
+    disks = read_disks(sources['diskstats'])
+    interfaces = read_network(sources['net'])
+    missing = (np.nan, np.nan)
+    record = [now]
+    record += [x for cpu in layout['cpus'] for x in cpus.get(cpu, missing)]
+    record += list(memory)
+    record += [x for disk in layout['disks'] for x in disks.get(disk, missing)]
+    record += [x for interface in layout['interfaces'] for x in interfaces.get(interface, missing)]
+    return np.array(record, dtype=np.float64)
+
+
+class ProcessTree:
+    """
+    Sampler of the CPU time, memory and IO of all descendants of a process. Processes are found by reading the parent
+    of every process in /proc at each sample. Processes that were orphaned, i.e. started in the background of a
+    subshell, are found as well if they are still in the session of the root process. The CPU time and IO of processes
+    that ended since the last sample are kept, so the totals only grow, but processes that start and end between two
+    samples are not seen.
+
+    Parameters to initiate
+    ----------
+    root: int = process id whose descendants are sampled.
+    exclude: list = process ids that, along with their descendants, are not sampled, i.e. the profilers.
+    exclude_file: str = file of further process ids to leave out, one per line, which is read before every sample.
+    """
+    def __init__(self, root: int, exclude: list = None, exclude_file: str = None):
+        self.root = root
+        # The sampler itself is usually a descendant of root as well
+        self.exclude = set(exclude if exclude is not None else []) | {os.getpid()}
+        self.exclude_file = exclude_file
+        self.page_size = os.sysconf('SC_PAGE_SIZE')
+        # Last CPU ticks, bytes read and bytes written of each running process, by (pid, start time)
+        self.running = {}
+        self.ended = np.zeros(3)
+
+    def read_processes(self):
+        # Parent, session, start time, CPU ticks and resident memory of every process, from the fields after the
+        # command name
+        processes = {}
+        for pid in os.listdir('/proc'):
+            if not pid.isdigit():
+                continue
+            try:
+                with open(f'/proc/{pid}/stat') as f:
+                    values = f.read().rsplit(')', 1)[1].split()
+            except (OSError, IndexError):
+                continue
+            processes[int(pid)] = (int(values[1]), int(values[3]), values[19],
+                                   float(values[11]) + float(values[12]), float(values[21]) * self.page_size)
+        return processes
+
+    def read_exclude_file(self):
+        # The profilers started after the sampler add themselves to the file, so it is read again every time
+        if self.exclude_file is None:
+            return set()
+        try:
+            with open(self.exclude_file) as f:
+                return {int(pid) for pid in f.read().split() if pid.isdigit()}
+        except OSError:
+            return set()
+
+    def descendants(self, processes: dict):
+        exclude = self.exclude | self.read_exclude_file()
+        children = {}
+        for pid, values in processes.items():
+            children.setdefault(values[0], []).append(pid)
+        session = processes[self.root][1] if self.root in processes else None
+        orphans = [pid for pid, values in processes.items() if values[0] == 1 and values[1] == session]
+        tree, queue = [], [self.root] + orphans
+        while queue:
+            pid = queue.pop()
+            if pid in exclude:
+                continue
+            tree += [pid]
+            queue += children.get(pid, [])
+        return [pid for pid in tree if pid in processes]
+
+    def sample(self):
+        """
+        sample reads the processes in the tree into one fixed width record.
+
+        Returns
+        -------
+        np.array of float64 with the time, the CPU ticks, the resident memory in bytes, the bytes read and the bytes
+        written of the tree, and the number of processes in it.
+        """
+        now = time.time()
+        processes = self.read_processes()
+        tree = self.descendants(processes)
+        running = {}
+        memory = 0.
+        for pid in tree:
+            parent, session, start, ticks, rss = processes[pid]
+            read_bytes, write_bytes = 0., 0.
+            try:
+                with open(f'/proc/{pid}/io') as f:
+                    io_counters = dict(line.split(': ') for line in f.read().splitlines())
+                read_bytes, write_bytes = float(io_counters['read_bytes']), float(io_counters['write_bytes'])
+            except (OSError, KeyError, ValueError):
+                pass
+            running[(pid, start)] = np.array([ticks, read_bytes, write_bytes])
+            memory += rss
+        for key in self.running.keys() - running.keys():
+            self.ended += self.running[key]
+        self.running = running
+        totals = self.ended + sum(running.values(), np.zeros(3))
+        return np.array([now, totals[0], memory, totals[1], totals[2], len(tree)], dtype=np.float64)
+
+
+def record_samples(output: str, interval: float, tree: int = None, exclude: list = None, exclude_file: str = None,
+                   batch: int = 30):
+    if tree is None:
+        sources = open_sources()
+        layout = {'version': layout_version, 'clock_ticks': os.sysconf('SC_CLK_TCK'),
+                  'cpus': list(read_cpus(sources['stat'])), 'disks': list(read_disks(sources['diskstats'])),
+                  'interfaces': list(read_network(sources['net']))}
+        take_sample = lambda: sample(sources, layout)
+    else:
+        sources = {}
+        process_tree = ProcessTree(tree, exclude, exclude_file)
+        layout = {'version': layout_version, 'clock_ticks': os.sysconf('SC_CLK_TCK'), 'tree': tree}
+        take_sample = process_tree.sample
+    prefix = file_prefixes[tree is not None]
+    with open(output + '/' + prefix + '_layout.json', 'w') as f:
+        json.dump(layout, f)
+    signal.signal(signal.SIGTERM, stop)
+    # Records are buffered and written a batch at a time, rather than each on its own, as the output path may be on a
+    # shared filesystem. The first record is written straight away, so others can wait for the sampler to be running.
+    with open(output + '/' + prefix + '_samples.bin', 'ab') as samples:
+        next_sample = time.time()
+        taken = 0
+        try:
+            while True:
+                samples.write(take_sample().tobytes())
+                taken += 1
+                if taken == 1 or taken % batch == 0:
+                    samples.flush()
+                next_sample += interval
+                time.sleep(max(0., next_sample - time.time()))
+        except (Stop, KeyboardInterrupt):
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            # One last sample, so that the end of the job is covered
+            samples.write(take_sample().tobytes())
+    for source in sources.values():
+        source.close()
+
+
+def to_dataframe(records: np.array, layout: dict):
+    """
+    to_dataframe turns the recorded counters into the columns and units of the prometheus data, i.e. the rate between
+    two samples, in the same way prometheus' irate does.
+
+    Parameters
+    ----------
+    records: np.array = 2D array of the records written by sample, one record per row.
+    layout: dict = layout the records were written with.
+
+    Returns
+    -------
+    pd.DataFrame with a 'Time' column followed by the CPU, memory, IO and network columns of the prometheus data.
+    """
+    seconds = np.diff(records[:, 0])
+    # Counters that reset, i.e. a device that was reattached, give no rate for that interval
+    rates = np.diff(records[:, 1:], axis=0) / seconds[:, None]
+    rates[rates < 0] = np.nan
+    n_cpus, n_disks, n_interfaces = len(layout['cpus']), len(layout['disks']), len(layout['interfaces'])
+    cpu_seconds = rates[:, :2 * n_cpus] / layout['clock_ticks']
+    memory = records[1:, 1 + 2 * n_cpus:3 + 2 * n_cpus]
+    disks = rates[:, 2 + 2 * n_cpus:2 + 2 * n_cpus + 2 * n_disks]
+    interfaces = rates[:, 2 + 2 * n_cpus + 2 * n_disks:]
+
+    columns = {'Time': pd.to_datetime(records[1:, 0], unit='s', utc=True)}
+    columns |= {f'CPU Usage: {cpu}': 100 - cpu_seconds[:, 2 * i] * 100 for i, cpu in enumerate(layout['cpus'])}
+    columns |= {f'CPU IO Wait: {cpu}': cpu_seconds[:, 2 * i + 1] * 100 for i, cpu in enumerate(layout['cpus'])}
+    columns['Memory Total [GB]'] = memory[:, 0] / 1e9
+    columns['Memory Usage [GB]'] = (memory[:, 0] - memory[:, 1]) / 1e9
+    columns |= {f'Write: {disk}': disks[:, 2 * i] / 1e9 for i, disk in enumerate(layout['disks'])}
+    columns |= {f'Read: {disk}': disks[:, 2 * i + 1] / 1e9 for i, disk in enumerate(layout['disks'])}
+    columns |= {f'Received: {interface}': interfaces[:, 2 * i] / 1e3 for i, interface in enumerate(layout['interfaces'])}
+    columns |= {f'Sent: {interface}': interfaces[:, 2 * i + 1] / 1e3 for i, interface in enumerate(layout['interfaces'])}
+    return pd.DataFrame(columns)
+
+
+def tree_to_dataframe(records: np.array, layout: dict):
+    """
+    tree_to_dataframe turns the recorded process tree counters into the process column families of the prometheus
+    data. CPU usage is given in cores, i.e. 2 for a tree keeping two cores busy, so it can be compared to the cores
+    requested, and the memory is the summed resident memory of the processes.
+
+    Parameters
+    ----------
+    records: np.array = 2D array of the records written by ProcessTree.sample, one record per row.
+    layout: dict = layout the records were written with.
+
+    Returns
+    -------
+    pd.DataFrame with a 'Time' column followed by the process CPU, memory, IO and process count columns.
+    """
+    seconds = np.diff(records[:, 0])
+    rates = np.diff(records[:, [1, 3, 4]], axis=0) / seconds[:, None]
+    rates[rates < 0] = np.nan
+    return pd.DataFrame({'Time': pd.to_datetime(records[1:, 0], unit='s', utc=True),
+                         'Process CPU Usage [cores]': rates[:, 0] / layout['clock_ticks'],
+                         'Process Memory [GB]': records[1:, 2] / 1e9,
+                         'Process Read [GB/s]': rates[:, 1] / 1e9,
+                         'Process Write [GB/s]': rates[:, 2] / 1e9,
+                         'Process Count': records[1:, 5]})
+
+
+def write_table(dataframe: pd.DataFrame, output_file: str):
+    table = pa.Table.from_pandas(dataframe, preserve_index=False)
+    table = table.replace_schema_metadata(table.schema.metadata |
+                                          {b'pyprofqueue_format': str(file_format_version).encode()})
+    # Uncompressed, so that it can be memory mapped like the prometheus data. Written next to output_file first, so
+    # that a file being merged into is only replaced once the merged file is complete.
+    with pa.ipc.new_file(output_file + '.tmp', table.schema) as writer:
+        writer.write_table(table)
+    os.replace(output_file + '.tmp', output_file)
+
+
+def convert(output: str, tree: bool = False):
+    prefix = file_prefixes[tree]
+    with open(output + '/' + prefix + '_layout.json') as f:
+        layout = json.load(f)
+    if tree:
+        width = 6
+    else:
+        width = 3 + 2 * (len(layout['cpus']) + len(layout['disks']) + len(layout['interfaces']))
+    records = np.fromfile(output + '/' + prefix + '_samples.bin', dtype=np.float64)
+    # A record that was only partly written when the sampler was killed is dropped
+    records = records[:len(records) // width * width].reshape(-1, width)
+    if len(records) < 2:
+        exit(f"Fewer than two samples were recorded in {output}, no rates can be computed.")
+    if tree:
+        dataframe = tree_to_dataframe(records, layout)
+    else:
+        dataframe = to_dataframe(records, layout)
+    write_table(dataframe, output + '/' + prefix + '_data.ft')
+
+
+def merge(output: str, merge_file: str, interval: float, overview: bool = False):
+    """
+    merge adds the process columns of output/process_data.ft to the prometheus data in merge_file, one record batch of
+    merge_file at a time, so only one scraped window is held in memory next to the process samples. Each time stamp of
+    merge_file gets the nearest process sample, if there is one within interval seconds. The time stamps of an overview
+    file start bins of the data instead, and get the mean of the process samples within their bin.
+
+    Parameters
+    ----------
+    output: str = path the process samples were written to.
+    merge_file: str = feather file of prometheus data, which is replaced by the merged data.
+    interval: float = seconds between two process samples.
+    overview: bool = whether merge_file is the downsampled overview file written by read_prometheus.py.
+    """
+    with pa.memory_map(output + '/process_data.ft') as source:
+        process_df = pa.ipc.open_file(source).read_pandas().sort_values('Time')
+    process_columns = [column for column in process_df.columns if column != 'Time']
+    with pa.memory_map(merge_file) as source:
+        reader = pa.ipc.open_file(source)
+        if reader.schema.metadata.get(b'pyprofqueue_format', b'1') != str(file_format_version).encode():
+            exit(f"{merge_file} was written in an older layout, process samples can only be merged into version "
+                 f"{file_format_version} files.")
+        # Process columns of an earlier merge are replaced, every other column is kept as it is
+        schema = pa.schema([field for field in reader.schema if field.name not in process_columns] +
+                           [pa.field(column, pa.float64()) for column in process_columns],
+                           metadata=reader.schema.metadata)
+        tolerance = pd.Timedelta(seconds=interval)
+        with pa.ipc.new_file(merge_file + '.tmp', schema) as writer:
+            for i in range(reader.num_record_batches):
+                dataframe = reader.get_batch(i).to_pandas()
+                dataframe = dataframe.drop(columns=[x for x in process_columns if x in dataframe.columns])
+                dataframe = dataframe.sort_values('Time')
+                if overview:
+                    dataframe = merge_bins(dataframe, process_df)
+                else:
+                    # Only the process samples around the window are merged, rather than all of them every time
+                    first = process_df['Time'].searchsorted(dataframe['Time'].iloc[0] - tolerance)
+                    last = process_df['Time'].searchsorted(dataframe['Time'].iloc[-1] + tolerance, side='right')
+                    dataframe = pd.merge_asof(dataframe, process_df.iloc[first:last], on='Time',
+                                              direction='nearest', tolerance=tolerance)
+                writer.write_batch(pa.RecordBatch.from_pandas(dataframe, schema=schema, preserve_index=False))
+    os.replace(merge_file + '.tmp', merge_file)
+
+
+def merge_bins(dataframe: pd.DataFrame, process_df: pd.DataFrame):
+    # The rows of an overview file start consecutive bins of equal length, the smallest difference between them
+    times = dataframe['Time']
+    width = times.diff().min() if len(times) > 1 else pd.Timedelta(0)
+    inside = process_df[(process_df['Time'] >= times.iloc[0]) & (process_df['Time'] < times.iloc[-1] + width)]
+    # Every process sample falls into the bin that starts last before it
+    binned = inside.drop(columns='Time').reset_index(drop=True)
+    binned['Time'] = pd.merge_asof(inside[['Time']], times.to_frame('Start'), left_on='Time', right_on='Start',
+                                   direction='backward')['Start']
+    return dataframe.merge(binned.groupby('Time').mean(), left_on='Time', right_index=True, how='left')
+
+
+def main():
+    if args.output is None:
+        exit("output is required")
+    if args.merge is not None:
+        merge(args.output, args.merge, args.interval)
+        if args.merge_overview is not None:
+            merge(args.output, args.merge_overview, args.interval, overview=True)
+        return
+    if not args.convert:
+        record_samples(args.output, args.interval, args.tree, args.exclude, args.exclude_file, args.batch)
+    convert(args.output, args.tree is not None)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main()
@@ -1,16 +1,19 @@
 from importlib import resources as impresources
-import subprocess, itertools, io, os
+import subprocess, itertools, io, os, re, shutil, hashlib, tempfile, json, shlex
 
 import matplotlib.collections as collection
+import matplotlib.cm as cm
 import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
-from pyarrow import output_stream
+import pyarrow as pa
 
 from . import data
 
 likwid_file_path = impresources.files(data) / 'likwid_commands.txt'
 likwid_initEndSplit = -1
+# Changing how the PYPROFQUEUE group is generated requires increasing this, so existing groups are generated again
+group_version = 1
 
 
 def define_initialise(profilefile: io.TextIOWrapper, profilerdict: dict = None):
@@ -22,7 +25,8 @@ def define_initialise(profilefile: io.TextIOWrapper, profilerdict: dict = None):
     ----------
     profilefile: io.TextIOWrapper = Open text file that can be written to and is being used to initiate, call and
         terminate all profiling codes that are to be executed with the user specified bash script.
-    profilerdict: dict = dictionary containing required arguments that the profiler has or other values.
+    profilerdict: dict = dictionary containing required arguments that the profiler has or other values, such as the
+        "interval" between two samples of the timeline.
 
     Returns
     -------
@@ -37,6 +41,18 @@ def define_initialise(profilefile: io.TextIOWrapper, profilerdict: dict = None):
             profilefile.write('\n')
     profilefile.write('\n')
     profilefile.write('export LIKWID_RUNNING_DIR=${WORKING_DIR}/Likwid\n')
+    # Seconds between two samples of likwid-perfctr, or a duration with the unit likwid expects, i.e. '500ms'
+    interval = profilerdict['interval'] if 'interval' in profilerdict.keys() else 120
+    profilefile.write('export LIKWID_INTERVAL={}\n'.format(f'{interval}s' if isinstance(interval, (int, float))
+                                                           else interval))
+    reduce_path = str(impresources.files(data).joinpath("fake"))[:-5]
+    profilefile.write('export LIKWID_SCRIPT={}\n'.format(reduce_path))
+    # likwid-bench calibrations older than this many days are run again
+    profilefile.write('export LIKWID_CALIBRATION_MAX_AGE={}\n'.format(
+        profilerdict['calibration_max_age'] if 'calibration_max_age' in profilerdict.keys() else 30))
+    profilefile.write('export LIKWID_CALIBRATION_CACHE=${XDG_CACHE_HOME:-$HOME/.cache}/pyprofqueue/likwid\n')
+    if 'host_class' in profilerdict.keys():
+        profilefile.write('export LIKWID_HOST_CLASS={}\n'.format(profilerdict['host_class']))
     with open(likwid_file_path, 'r') as read_file:
         for number, line in enumerate(read_file):
             if line == '# *=*\n':
@@ -50,7 +66,9 @@ def define_initialise(profilefile: io.TextIOWrapper, profilerdict: dict = None):
 def define_run(profilefile: io.TextIOWrapper, bash_options: list = [''], works: list = None,
                tmp_work_script: str = None, work_script: str = None, profilerdict: dict = None):
     """
-    define_run calls the user given bash script using likwid to execute and profile the work done.
+    define_run calls the user given bash script using likwid to execute and profile the work done. If "code_lines" is
+    given in profilerdict, only the lines of the work script matching one of them are profiled, each as its own region
+    whose output files are numbered in the order the lines appear, i.e. temp_out_0.txt and likwid_timeline_0.arrow.
 
     Parameters
     ----------
@@ -64,28 +82,44 @@ def define_run(profilefile: io.TextIOWrapper, bash_options: list = [''], works:
     -------
     None
     """
-    profiling_call = f'likwid-perfctr -g PYPROFQUEUE -t 120s -O -f '
-    output_call = " 2> ${LIKWID_RUNNING_DIR}/temp_likwid.txt > ${LIKWID_RUNNING_DIR}/temp_out.txt\n"
-
-    if tmp_work_script is None and (profilerdict is None or 'code_line' not in profilerdict.keys()):
+    profiling_call = f'likwid-perfctr -g PYPROFQUEUE -t ${{LIKWID_INTERVAL}} -O -f '
+    # The timeline likwid writes to stderr is reduced while the work runs, rather than kept as text. The exit status of
+    # the line is that of the work rather than of the reducer at the end of the pipe
+    output_call = (" 2>&1 > ${LIKWID_RUNNING_DIR}/temp_out.txt | "
+                   "${PYTHON_INSTANCE} ${LIKWID_SCRIPT}/reduce_likwid.py -o ${LIKWID_RUNNING_DIR}; "
+                   "(exit ${PIPESTATUS[0]})\n")
+
+    if tmp_work_script is None and (profilerdict is None or 'code_lines' not in profilerdict.keys()):
         profilefile.write(profiling_call + 'bash ' +
                           '{} {}'.format(work_script, ' '.join([str(x) for x in bash_options])) +
                           output_call)
-    elif (profilerdict is None or 'code_line' not in profilerdict.keys()):
+    elif (profilerdict is None or 'code_lines' not in profilerdict.keys()):
         profilefile.write(profiling_call + 'bash ' +
                           '{} {}'.format(tmp_work_script, ' '.join([str(x) for x in bash_options])) +
                           output_call)
-    elif ('code_line' in profilerdict.keys()):
+    elif ('code_lines' in profilerdict.keys()):
         with open(tmp_work_script, 'r') as workfile:
             workfile.seek(0)
             data = workfile.readlines()
+        regions = {}
         for line in range(len(data)):
-            for profile_line in profilerdict['code_line']:
+            for profile_line in profilerdict['code_lines']:
                 if data[line] == profile_line+'\n':
-                    data[line] = profiling_call + data[line].strip() + output_call
+                    region = len(regions)
+                    regions[region] = profile_line
+                    data[line] = (profiling_call + data[line].strip() +
+                                  f" 2>&1 > ${{LIKWID_RUNNING_DIR}}/temp_out_{region}.txt | ${{PYTHON_INSTANCE}} "
+                                  f"${{LIKWID_SCRIPT}}/reduce_likwid.py -o ${{LIKWID_RUNNING_DIR}} -r {region}; "
+                                  "(exit ${PIPESTATUS[0]})\n")
+                    break
         with open(tmp_work_script, 'w') as workfile:
             workfile.seek(0)
             workfile.writelines(data)
+        if len(regions) == 0:
+            print(f"None of the code_lines given for likwid were found in {tmp_work_script}, so nothing is profiled.")
+        # Lists which code line each region is, for the region summary at the end of the job
+        profilefile.write('echo {} > ${{LIKWID_RUNNING_DIR}}/likwid_regions.json\n'.format(
+            shlex.quote(json.dumps(regions))))
         profilefile.write('bash {} {}\n'.format(tmp_work_script, ' '.join([str(x) for x in bash_options])))
     else:
         profilefile.write(profiling_call +
@@ -119,43 +153,73 @@ def define_end(profilefile: io.TextIOWrapper):
     profilefile.write('\n')
     return
 
-def create_custom_group():
-    architecture = subprocess.run(
-        "likwid-perfctr -i | awk '/CPU short:/ {print $NF}'",
-        capture_output=True,
-        shell = True,
-        text=True
-    ).stdout.strip("\n")
-    if architecture == "":
-        architecture = subprocess.run(
-            "likwid-perfctr -i | awk '/cpu short:/ {print $NF}'",
-            capture_output=True,
-            shell = True,
-            text=True
-        ).stdout.strip("\n")
-    if 'Cannot access directory' in architecture:
-        SystemExit("Unknown Architecture for likwid, unable to use likwid on this system")
-    groups_location = subprocess.run(
-        ['which', 'likwid-perfctr'],
-        capture_output=True,
-        text=True
-    ).stdout[:-2]
+def likwid_architecture():
+    # Short name of the CPU architecture as likwid calls it, i.e. 'zen3'
+    info = subprocess.run(['likwid-perfctr', '-i'], capture_output=True, text=True).stdout
+    for line in info.split('\n'):
+        if line.lower().startswith('cpu short:'):
+            return line.split()[-1]
+    exit("Unknown Architecture for likwid, unable to use likwid on this system")
+
+
+def read_perfgroups(architecture: str):
+    # Contents of the MEM and FLOPS perfgroup files that ship with likwid for the architecture, by file name
+    likwid_perfctr = shutil.which('likwid-perfctr')
+    if likwid_perfctr is None:
+        exit("likwid-perfctr was not found, unable to use likwid on this system")
     perfgroups_location = os.path.abspath(
         os.path.join(
-            groups_location,
-            '..' if '/bin' not in groups_location else '../..',
+            os.path.dirname(likwid_perfctr),
+            '.' if '/bin' not in likwid_perfctr else '..',
             f'share/likwid/perfgroups/{architecture}'
         )
     )
-    ls_results = subprocess.run(f"ls {perfgroups_location}", shell=True, capture_output=True, text=True).stdout.strip().split('\n')
+    perfgroups = {}
+    for group in sorted(os.listdir(perfgroups_location)):
+        if "MEM" in group or "FLOPS" in group:
+            with open(os.path.join(perfgroups_location, group), 'r') as read_file:
+                perfgroups[group] = read_file.read()
+    return perfgroups
+
+
+def create_custom_group(groups_location: str = None, architecture: str = None):
+    """
+    create_custom_group writes the PYPROFQUEUE likwid group, which measures FLOP/s, memory bandwidth and operational
+    intensity, for the architecture of the node into the likwid groups directory of the user. The group is built from
+    the MEM and FLOPS groups that ship with likwid, and is only generated again if those groups or group_version
+    changed since it was written.
+
+    Parameters
+    ----------
+    groups_location: str = directory that holds the likwid groups of the user, defaults to ~/.likwid/groups.
+    architecture: str = short name of the CPU architecture as given by likwid-perfctr -i, which is run to find it if
+        it is not given.
+
+    Returns
+    -------
+    str of the path to the group file
+    """
+    if groups_location is None:
+        groups_location = os.path.expanduser('~/.likwid/groups')
+    if not architecture:
+        architecture = likwid_architecture()
+    perfgroups = read_perfgroups(architecture)
+    source_hash = hashlib.sha256(repr((group_version, architecture, perfgroups)).encode()).hexdigest()
+    marker = f"Generated by PyProfQueue group version {group_version} from perfgroups {source_hash}"
+    group_file = os.path.join(groups_location, architecture, 'PYPROFQUEUE.txt')
+    if os.path.isfile(group_file):
+        with open(group_file, 'r') as read_file:
+            if read_file.read().rstrip('\n').endswith(marker):
+                return group_file
+
     memory_variables = {}
     memory_long_line = ""
     flop_variables = {}
     flop_metric_lines = []
     flop_long_line = ""
-    for group in ls_results:
+    for group, contents in perfgroups.items():
         if "MEM" in group:
-            lines = subprocess.run(f"cat {perfgroups_location}/{group}", shell=True, capture_output=True, text=True).stdout.strip().split('\n')
+            lines = contents.strip().split('\n')
             counter_name_format = ""
             counter_variables = []
             passed_long = False
@@ -182,8 +246,7 @@ def create_custom_group():
                 memory_variables[variable] = counter_name_format + (
                     variable[-2:] if variable[-2].isdigit() else variable[-1:])
         elif "FLOPS" in group:
-            lines = subprocess.run(["cat", perfgroups_location + "/" + group], capture_output=True,
-                                   text=True).stdout.strip().split('\n')
+            lines = contents.strip().split('\n')
             counter_names = []
             counter_variables = []
             passed_long = False
@@ -240,29 +303,119 @@ def create_custom_group():
         memory_long_line.replace("bandwidth [MBytes/s]", "data volume [Bytes]")[:-5] + '\n',
         f'Operational intensity [FLOP/Byte] ({list(flop_variables.values())[0] if "ALL" in list(flop_variables.values())[0] else list(flop_variables.values())[0][:-1] + "*"})/(({list(memory_variables.values())[0][:-1]}*)*64.0)\n'
         "-\n"
-        "Custom group for PyProfQueue to calculate Operational Intensity for Roofline model"
+        "Custom group for PyProfQueue to calculate Operational Intensity for Roofline model\n",
+        marker + "\n"
     ]
 
-    with open(f"{os.getcwd()}/PYPROFQUEUE.txt", 'w') as fp:
+    # Written to a temporary file that replaces the group in one step, as array jobs sharing a home directory may
+    # write the group at the same time
+    os.makedirs(os.path.dirname(group_file), exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(group_file), prefix='.PYPROFQUEUE.',
+                                     delete=False) as fp:
         for line in group_doc_lines:
             fp.write(line)
+    os.chmod(fp.name, 0o644)
+    os.replace(fp.name, group_file)
+    return group_file
+
+def read_ceilings(performance_file: str):
+    """
+    read_ceilings reads the peak FLOP/s and memory bandwidths that likwid-bench measured into the likwid performance
+    output, in which each measurement follows the line naming it, i.e. 'AVX MFlops/s' followed by 'MFlops/s: 1234.5'.
+    Measurements that failed, i.e. AVX on a CPU without it, are left out.
+
+    Returns
+    -------
+    dict of the names of the peak performances to MFLOP/s, and dict of the names of the bandwidths to MByte/s
+    """
+    peaks, bandwidths = {}, {}
+    name = None
+    with open(performance_file, 'r') as read_file:
+        for line in read_file:
+            measurement = re.match(r'(MFlops/s|MByte/s):\s*([\d.]+)', line.strip())
+            if measurement is None:
+                name = line.strip().rsplit(' ', 1)[0]
+            elif name:
+                ceilings = peaks if measurement.group(1) == 'MFlops/s' else bandwidths
+                ceilings[name] = max(ceilings.get(name, 0.), float(measurement.group(2)))
+    return peaks, bandwidths
+
+
+def roofline_ceilings(maxperf: float, maxband: float, ceilings_file: str = None):
+    """
+    roofline_ceilings lists the rooflines to plot, the roofline of maxperf and maxband first, followed by one roofline
+    per instruction set measured into ceilings_file, pairing its peak FLOP/s with the bandwidth of its loads.
+
+    Returns
+    -------
+    list of the names of the rooflines, and np.arrays of their peak performance and their bandwidth
+    """
+    names, peaks, bandwidths = ['Roofline'], [maxperf], [maxband]
+    if ceilings_file is not None:
+        file_peaks, file_bandwidths = read_ceilings(ceilings_file)
+        for name in file_peaks:
+            # maxperf and maxband are read from the same file by the profile script, so up to their rounding
+            if name in file_bandwidths and not np.allclose([file_peaks[name], file_bandwidths[name]],
+                                                           [maxperf, maxband], rtol=1e-6, atol=1.):
+                names += [f'{name} ceiling']
+                peaks += [file_peaks[name]]
+                bandwidths += [file_bandwidths[name]]
+    return names, np.array(peaks, dtype=np.float64), np.array(bandwidths, dtype=np.float64)
+
+
+def attainable(intensity: np.array, peaks: np.array, bandwidths: np.array):
+    """
+    attainable gives the performance each roofline allows at each operational intensity, i.e. the lower of the peak
+    performance and the intensity times the bandwidth.
+
+    Returns
+    -------
+    np.array of shape intensity.shape + (rooflines,)
+    """
+    return np.minimum(np.multiply.outer(intensity, bandwidths), peaks)
+
+
+def attainable_percentages(intensity: np.array, performance: np.array, peaks: np.array, bandwidths: np.array):
+    """
+    attainable_percentages places every sample relative to its nearest ceiling, the lowest roofline that is still at
+    or above it, and gives the percentage of that ceiling the sample attains. Samples above every roofline are placed
+    relative to the highest one.
+
+    Returns
+    -------
+    np.array of the index of the nearest ceiling of each sample, and np.array of the percentage attained
+    """
+    ceilings = attainable(np.asarray(intensity, dtype=np.float64), peaks, bandwidths)
+    above = np.where(ceilings >= np.asarray(performance)[..., None], ceilings, np.inf)
+    nearest = np.where(np.isinf(above.min(axis=-1)), np.nan_to_num(ceilings, nan=-np.inf).argmax(axis=-1),
+                       above.argmin(axis=-1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percentages = 100 * performance / np.take_along_axis(ceilings, nearest[..., None], axis=-1)[..., 0]
+    return nearest, percentages
+
+
+def roofline_axis(peaks: np.array, bandwidths: np.array, max_x: float, log_plot: bool = False):
+    # The rooflines are straight lines between their ridge points, on linear as well as on log-log axes
+    min_x = (peaks / bandwidths).min() / 100 if log_plot else 0
+    return np.unique(np.concatenate([[min_x], peaks / bandwidths, [max_x]]))
 
-    return
 
 def plot_likwid_roof_single(name_prefix: str,
                             maxperf: float,
                             maxband: float,
                             code_name: str = 'code',
                             code_mflop: float = None,
-                            code_opint: float = None):
-    if code_mflop is not None:
-        if code_opint * maxband < maxperf:
-            Percentage = int((code_mflop / (code_opint * maxband)) * 100)
+                            code_opint: float = None,
+                            ceilings_file: str = None,
+                            log_plot: bool = False):
+    names, peaks, bandwidths = roofline_ceilings(maxperf, maxband, ceilings_file)
+    Dot = code_mflop is not None
+    if Dot:
+        nearest, percentage = attainable_percentages(code_opint, code_mflop, peaks, bandwidths)
+        if nearest == 0:
+            label = f'{code_name} Performance [~{int(percentage)}% of roofline]'
         else:
-            Percentage = int((code_mflop / maxperf) * 100)
-        Dot = True
-    else:
-        Dot = False
+            label = f'{code_name} Performance [~{int(percentage)}% of {names[nearest]}]'
 
     if maxperf / maxband > 1:
         max_x = (maxperf / maxband) * 2
@@ -273,46 +426,222 @@ def plot_likwid_roof_single(name_prefix: str,
         if (max_x < code_opint):
             max_x = code_opint
 
-    x_Axis = np.append(np.linspace(0, maxperf / maxband, 10), max_x)
-    y = np.array([x * maxband if ((x * maxband) < maxperf) else maxperf for x in x_Axis])
+    x_Axis = roofline_axis(peaks, bandwidths, max_x * 10 if log_plot else max_x, log_plot)
+    y = attainable(x_Axis, peaks, bandwidths)
     Roofline = plt.figure(figsize=(10, 7))
     Roofline.suptitle("Roofline Model", fontsize=20)
-    plt.plot(x_Axis, y, label="Roofline")
+    plt.plot(x_Axis, y[:, 0], label="Roofline")
+    for number in range(1, len(names)):
+        plt.plot(x_Axis, y[:, number], linestyle=':', label=names[number])
     plt.vlines(maxperf / maxband, 0, maxperf, linestyle='--', color='gray', alpha=0.5,
                label='Bandwidth to CPU limit boarder')
     plt.xlabel("Operational Intensity")
     plt.ylabel("Performance [MFLOP/s]")
     if Dot:
-        plt.plot(code_opint, code_mflop, 'ro', label=f'{code_name} Performance [~{Percentage}% of roofline]')
-        plt.xlim([0, x_Axis.max()])
-    plt.ylim([0, maxperf * 1.1])
+        plt.plot(code_opint, code_mflop, 'ro', label=label)
+        plt.xlim([x_Axis.min(), x_Axis.max()])
+    if log_plot:
+        plt.xscale('log')
+        plt.yscale('log')
+        plt.xlim([x_Axis.min(), x_Axis.max()])
+        plt.ylim([y[0].min() / 2, peaks.max() * 2])
+    else:
+        plt.ylim([0, peaks.max() * 1.1])
     plt.legend(loc='upper left')
     plt.savefig(name_prefix + '_Roofline.png', bbox_inches='tight')
     return
 
 
-def read_timeseries(likwid_file: str):
-    likwid_header = pd.read_csv(likwid_file, header=None, skiprows=1, nrows=1, delimiter='|')
-    likwid_dataframe = pd.read_csv(likwid_file, skiprows=[0, 1], header=None, delimiter=',')
-    metrics = likwid_dataframe.iloc[0, 1]
-    cpu_count = likwid_dataframe.iloc[0, 2]
-    header = ["GID", "MetricsCount", "CpuCount", "Total runtime [s]"]
-    for metric in range(4, metrics + 4):
-        for cpu in range(cpu_count):
-            header += [f"Thread {cpu}: {likwid_header.iloc[0, metric]}"]
-    likwid_dataframe.columns = header
-
-    keep = []
-    for name in header:
-        if 'Operational intensity' in name or "[FLOP/s]" in name or "Total runtime [s]" in name:
-            keep += [True]
+def read_timeline(timeline_file: str):
+    """
+    read_timeline reads the samples that reduce_likwid.py wrote as Arrow records. A record that was only partly
+    written, because the reducer was killed, is dropped.
+
+    Returns
+    -------
+    pa.Table with a 'Runtime' column followed by one column per value of the samples
+    """
+    batches = []
+    with pa.memory_map(timeline_file) as source, pa.ipc.open_stream(source) as reader:
+        try:
+            for batch in reader:
+                batches += [batch]
+        except (pa.ArrowInvalid, OSError):
+            pass
+        return pa.Table.from_batches(batches, schema=reader.schema)
+
+
+def read_aggregates(aggregates_file: str):
+    """
+    read_aggregates reads the rolling aggregates that reduce_likwid.py wrote next to the timeline, if the job ran long
+    enough for their windows to hold more than one sample. Shorter jobs have a timeline that is as small and more
+    detailed, so it is read instead.
+
+    Returns
+    -------
+    pa.Table with the 'Start', 'End' and 'Samples' of every window followed by the 'Mean N', 'Min N' and 'Max N' of
+    every value N of the samples, or None if there is no such file or its windows hold single samples
+    """
+    if aggregates_file is None or not os.path.exists(aggregates_file):
+        return None
+    with pa.memory_map(aggregates_file) as source:
+        aggregates = pa.ipc.open_file(source).read_all()
+    if int(aggregates.schema.metadata.get(b'window_samples', b'1')) <= 1:
+        return None
+    return aggregates
+
+
+def read_thread_timeseries(likwid_file: str, like: tuple = ('Operational intensity', '[FLOP/s]'),
+                           timeline_file: str = None, aggregates_file: str = None):
+    """
+    read_thread_timeseries reads the timeline of likwid-perfctr in a single pass. The '|' separated header is parsed
+    once, and of the comma separated samples only the runtime and the columns of metrics whose name contains one of
+    like are read, as floats.
+
+    Parameters
+    ----------
+    likwid_file: str = path to the likwid output, its second line is the header and the samples start on its third.
+    like: tuple = parts of the names of the metrics to read, i.e. '[FLOP/s]'.
+    timeline_file: str = path to the samples written by reduce_likwid.py, which are read instead of the samples in
+        likwid_file if given.
+    aggregates_file: str = path to the rolling aggregates written by reduce_likwid.py. If the job was long enough for
+        their windows to be merged, the mean of every window is read in place of the samples, with the runtime of the
+        last sample of the window.
+
+    Returns
+    -------
+    np.array of the runtime at each sample, and dict of metric names to np.arrays of shape (samples, threads)
+    """
+    aggregates = read_aggregates(aggregates_file)
+    with open(likwid_file, 'r') as read_file:
+        read_file.readline()
+        header = read_file.readline().rstrip('\n').split('|')
+        if aggregates is not None:
+            timeline = aggregates
+            metric_count = int(timeline.schema.metadata[b'metrics_count'])
+            cpu_count = int(timeline.schema.metadata[b'cpu_count'])
+        elif timeline_file is not None:
+            timeline = read_timeline(timeline_file)
+            metric_count = int(timeline.schema.metadata[b'metrics_count'])
+            cpu_count = int(timeline.schema.metadata[b'cpu_count'])
         else:
-            keep += [False]
-    reduced_dataframe = likwid_dataframe.loc[:, keep]
-    time = reduced_dataframe.filter(like='Total runtime [s]').sum(1).values
-    op_int = reduced_dataframe.filter(like='Operational intensity').sum(1).values
-    flop_s = reduced_dataframe.filter(like='[FLOP/s]').sum(1).values
-    return time, op_int, flop_s
+            start = read_file.tell()
+            first_sample = read_file.readline().split(',')
+            read_file.seek(start)
+            metric_count, cpu_count = int(first_sample[1]), int(first_sample[2])
+        # Samples hold GID, MetricsCount, CpuCount and the runtime, followed by every thread of the first metric, then
+        # every thread of the second metric and so on
+        names = [name for name in header[4:4 + metric_count] if any(part in name for part in like)]
+        first_columns = {name: 4 + header[4:].index(name) * cpu_count for name in names}
+        usecols = [3] + [column for first in first_columns.values() for column in range(first, first + cpu_count)]
+        if aggregates is not None:
+            # The aggregates hold the means of the values only, numbered without the runtime
+            values = np.stack([aggregates.column('End').to_numpy()] +
+                              [aggregates.column(f'Mean {column - 4}').to_numpy() for column in usecols[1:]], axis=1)
+        elif timeline_file is not None:
+            # The records hold the runtime and the values, without GID, MetricsCount and CpuCount
+            values = np.stack([timeline.column(column - 3).to_numpy() for column in usecols], axis=1)
+        else:
+            values = pd.read_csv(read_file, header=None, usecols=usecols, dtype=np.float64, engine='c').to_numpy()
+    # read_csv returns the columns in the order of the file, which is the order of usecols
+    threads = {name: values[:, 1 + number * cpu_count:1 + (number + 1) * cpu_count]
+               for number, name in enumerate(names)}
+    return values[:, 0], threads
+
+
+def read_timeseries(likwid_file: str, timeline_file: str = None, aggregates_file: str = None):
+    time, threads = read_thread_timeseries(likwid_file, like=('Operational intensity', '[FLOP/s]',
+                                                              'Memory Bandwidth [Bytes/s]'),
+                                           timeline_file=timeline_file, aggregates_file=aggregates_file)
+    op_int = np.zeros(len(time))
+    flop_s = np.zeros(len(time))
+    bandwidth = np.zeros(len(time))
+    for name, values in threads.items():
+        if 'Operational intensity' in name:
+            op_int += np.nansum(values, axis=1)
+        if '[FLOP/s]' in name:
+            flop_s += np.nansum(values, axis=1)
+        if 'Memory Bandwidth [Bytes/s]' in name:
+            bandwidth += np.nansum(values, axis=1)
+    if any('Memory Bandwidth [Bytes/s]' in name for name in threads):
+        # The intensity of the node is its total FLOP/s over its total bandwidth, rather than the sum of the
+        # intensities of its threads. Groups without a bandwidth metric keep the summed intensities.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            op_int = np.where(bandwidth > 0, flop_s / bandwidth, np.nan)
+    return np.nan_to_num(time), op_int, flop_s
+
+
+def thread_sockets(likwid_file: str, cpu_count: int):
+    """
+    thread_sockets finds the hardware thread of each column of the likwid timeline from its '# HWThreads:' line, and
+    the socket of each thread from the CPU topology in /sys. Threads whose socket can not be read, i.e. because the
+    output is read on another machine, are placed on socket 0.
+
+    Returns
+    -------
+    np.array of the hardware thread ids, and np.array of their socket ids
+    """
+    with open(likwid_file, 'r') as read_file:
+        first_line = read_file.readline()
+    try:
+        thread_ids = [int(x) for x in re.split(r'[\s,|]+', first_line.split(':', 1)[1].strip())]
+    except (IndexError, ValueError):
+        thread_ids = []
+    if len(thread_ids) != cpu_count:
+        thread_ids = list(range(cpu_count))
+    sockets = []
+    for thread_id in thread_ids:
+        try:
+            with open(f'/sys/devices/system/cpu/cpu{thread_id}/topology/physical_package_id', 'r') as read_file:
+                sockets += [int(read_file.read())]
+        except (OSError, ValueError):
+            sockets += [0]
+    return np.array(thread_ids), np.array(sockets)
+
+
+def roofline_series(likwid_file: str, per: str = 'node', timeline_file: str = None, aggregates_file: str = None):
+    """
+    roofline_series sums the FLOP/s and memory bandwidth of the hardware threads of each thread, socket or the whole
+    node, and divides the summed FLOP/s by the summed bandwidth to get the operational intensity of each.
+
+    Parameters
+    ----------
+    likwid_file: str = path to the likwid output.
+    per: str = 'node', 'socket' or 'thread', the threads that are summed into one series.
+    timeline_file: str = path to the samples written by reduce_likwid.py, if they are not in likwid_file.
+    aggregates_file: str = path to the rolling aggregates written by reduce_likwid.py, read instead of the samples for
+        long jobs.
+
+    Returns
+    -------
+    np.array of the runtime at each sample, list of the names of the series, and np.arrays of the FLOP/s, the
+    operational intensity and the share of the threads of each series, the first two of shape (samples, series)
+    """
+    if per not in ['node', 'socket', 'thread']:
+        exit(f"per must be either 'node', 'socket' or 'thread', {per} was given.")
+    time, threads = read_thread_timeseries(likwid_file, like=('[FLOP/s]', 'Memory Bandwidth [Bytes/s]'),
+                                           timeline_file=timeline_file, aggregates_file=aggregates_file)
+    flop_s = [values for name, values in threads.items() if '[FLOP/s]' in name]
+    bandwidth = [values for name, values in threads.items() if 'Memory Bandwidth [Bytes/s]' in name]
+    if len(flop_s) == 0 or len(bandwidth) == 0:
+        exit(f"{likwid_file} does not contain both a [FLOP/s] and a Memory Bandwidth [Bytes/s] metric.")
+    flop_s, bandwidth = np.nan_to_num(sum(flop_s)), np.nan_to_num(sum(bandwidth))
+    cpu_count = flop_s.shape[1]
+    thread_ids, sockets = thread_sockets(likwid_file, cpu_count)
+    if per == 'thread':
+        names, groups = [f'thread {thread_id}' for thread_id in thread_ids], np.arange(cpu_count)
+    elif per == 'socket':
+        socket_ids, groups = np.unique(sockets, return_inverse=True)
+        names = [f'socket {socket_id}' for socket_id in socket_ids]
+    else:
+        names, groups = ['node'], np.zeros(cpu_count, dtype=int)
+    # Sums the threads of every series at once, as a product with a (threads, series) matrix of ones and zeros
+    membership = np.zeros((cpu_count, len(names)))
+    membership[np.arange(cpu_count), groups] = 1
+    group_flop_s, group_bandwidth = flop_s @ membership, bandwidth @ membership
+    with np.errstate(divide='ignore', invalid='ignore'):
+        intensity = np.where(group_bandwidth > 0, group_flop_s / group_bandwidth, np.nan)
+    return np.nan_to_num(time), names, group_flop_s, intensity, membership.sum(0) / cpu_count
 
 
 def plot_roof_timeseries(likwid_file: str,
@@ -320,8 +649,18 @@ def plot_roof_timeseries(likwid_file: str,
                          maxperf: float,
                          maxband: float,
                          code_name: str = 'code',
-                         log_plot: bool = False):
-    time_series, code_opint, code_mflop = read_timeseries(likwid_file)
+                         log_plot: bool = False,
+                         per: str = None,
+                         timeline_file: str = None,
+                         ceilings_file: str = None,
+                         aggregates_file: str = None):
+    if per is not None:
+        plot_roof_series(likwid_file, name_prefix, maxperf, maxband, code_name=code_name, log_plot=log_plot, per=per,
+                         timeline_file=timeline_file, aggregates_file=aggregates_file)
+        return
+    time_series, code_opint, code_mflop = read_timeseries(likwid_file, timeline_file=timeline_file,
+                                                          aggregates_file=aggregates_file)
+    names, peaks, bandwidths = roofline_ceilings(maxperf, maxband, ceilings_file)
     points = np.array([code_opint, code_mflop*1.0e-6]).T.reshape(-1, 1, 2)
     segments = np.concatenate([points[:-1], points[1:]], axis=1)
     if maxperf / maxband > 1:
@@ -332,8 +671,12 @@ def plot_roof_timeseries(likwid_file: str,
     if max_x < code_opint.max():
         max_x = code_opint.max()
 
-    x_axis = np.append(np.linspace(0, maxperf / maxband, 10), max_x*1.1)
-    y = np.array([x * maxband if ((x * maxband) < maxperf) else maxperf for x in x_axis])
+    x_axis = roofline_axis(peaks, bandwidths, max_x * (10 if log_plot else 1.1), log_plot)
+    y = attainable(x_axis, peaks, bandwidths)
+    nearest, percentages = attainable_percentages(code_opint, code_mflop * 1.0e-6, peaks, bandwidths)
+    # Number of samples and median percentage attained of the samples nearest to each roofline, for the legend
+    attained = np.isfinite(percentages)
+    sample_counts = np.bincount(nearest[attained], minlength=len(names))
 
     fig, axs = plt.subplots(1, 1, sharex=True, sharey=True)
     norm = plt.Normalize(time_series.min(), time_series.max())
@@ -347,19 +690,200 @@ def plot_roof_timeseries(likwid_file: str,
     pc.set_array(time_series)
     pc.set_label(code_name)
 
-    axs.plot(x_axis, y, label="Hardware Roofline")
+    for number, name in enumerate(names):
+        label = "Hardware Roofline" if number == 0 else name
+        if sample_counts[number] > 0:
+            median = np.median(percentages[attained & (nearest == number)])
+            label += f' [{sample_counts[number]} samples, median ~{int(median)}% attained]'
+        axs.plot(x_axis, y[:, number], linestyle='-' if number == 0 else ':', label=label)
     axs.vlines(maxperf / maxband, 0, maxperf, linestyle='--', color='gray', alpha=0.5,
                label='Mem BandWidth to CPU limit boarder')
     line = axs.add_collection(lc)
     fig.colorbar(line, ax=axs, label='Time [s]')
 
-    axs.set_xlim(0, max_x*1.1)
+    axs.set_xlim(x_axis.min(), x_axis.max())
     if log_plot:
+        axs.set_xscale('log')
         axs.set_yscale('log')
-        axs.set_ylim(1e-10, maxperf * 3)
+        axs.set_ylim(y[0].min() / 2, peaks.max() * 2)
         axs.set_ylabel('Performance log([MFLOP/s])')
     else:
-        axs.set_ylim(0, maxperf*1.05)
+        axs.set_ylim(0, peaks.max()*1.05)
         axs.set_ylabel('Performance [MFLOP/s]')
+    axs.legend(loc='upper left', fontsize='small')
     axs.set_xlabel('Operational Intensity')
     plt.savefig(name_prefix + '_TimeSeriesRoofline.png', bbox_inches='tight')
+
+
+def plot_roof_series(likwid_file: str,
+                     name_prefix: str,
+                     maxperf: float,
+                     maxband: float,
+                     code_name: str = 'code',
+                     log_plot: bool = False,
+                     per: str = 'socket',
+                     timeline_file: str = None,
+                     aggregates_file: str = None):
+    """
+    plot_roof_series plots the roofline time series of every socket or hardware thread, or of the whole node, with
+    the operational intensity of each being its summed FLOP/s over its summed memory bandwidth. The lines of all series
+    are drawn as one collection coloured by series, and their samples as one collection coloured by time. The
+    rooflines are scaled by the share of the threads of the node that a series holds.
+    """
+    time_series, names, flop_s, intensity, shares = roofline_series(likwid_file, per=per, timeline_file=timeline_file,
+                                                                    aggregates_file=aggregates_file)
+    # (series, samples, 2) points, segments between two samples are left out if either has no intensity
+    points = np.stack([intensity.T, flop_s.T * 1.0e-6], axis=-1)
+    segments = np.stack([points[:, :-1], points[:, 1:]], axis=2).reshape(-1, 2, 2)
+    drawn = np.isfinite(segments).all(axis=(1, 2))
+    series_number = np.repeat(np.arange(len(names)), max(len(time_series) - 1, 0))[drawn]
+    segments = segments[drawn]
+    valid = np.isfinite(points).all(axis=-1)
+    max_x = max(maxperf / maxband * 2 if maxperf / maxband > 1 else 1, np.nanmax(intensity, initial=0))
+
+    fig, axs = plt.subplots(1, 1, figsize=(10, 7))
+    fig.suptitle(f"Roofline Model per {per}", fontsize=20)
+    if len(names) <= 10:
+        series_colours = plt.get_cmap('tab10')(np.arange(len(names)))
+    else:
+        series_colours = plt.get_cmap('turbo')(np.linspace(0, 1, len(names)))
+    axs.add_collection(collection.LineCollection(segments, colors=series_colours[series_number], linewidths=1.5,
+                                                 alpha=0.7))
+    norm = plt.Normalize(time_series.min(), time_series.max())
+    pc = collection.RegularPolyCollection(numsides=4, offsets=points[valid], offset_transform=axs.transData,
+                                          cmap='viridis', norm=norm, sizes=[30] * int(valid.sum()))
+    pc.set_array(np.broadcast_to(time_series, valid.shape)[valid])
+    axs.add_collection(pc)
+    fig.colorbar(pc, ax=axs, label='Time [s]')
+
+    x_axis = roofline_axis(np.array([maxperf]), np.array([maxband]), max_x * (10 if log_plot else 1.1), log_plot)
+    rooflines = [np.stack([x_axis, attainable(x_axis, maxperf, maxband) * share], axis=1)
+                 for share in np.unique(shares)]
+    axs.add_collection(collection.LineCollection(rooflines, colors='k', linestyles='--', label="Hardware Roofline"))
+    if len(names) <= 10:
+        for number, name in enumerate(names):
+            axs.plot([], [], color=series_colours[number], label=f'{code_name} {name}')
+    else:
+        # Too many series for a legend, their colour is given by a second colour bar instead
+        fig.colorbar(cm.ScalarMappable(norm=plt.Normalize(0, len(names) - 1), cmap='turbo'), ax=axs,
+                     label=f'{per.capitalize()} number')
+    axs.legend(loc='upper left')
+
+    axs.set_xlim(x_axis.min(), x_axis.max())
+    if log_plot:
+        axs.set_xscale('log')
+        axs.set_yscale('log')
+        axs.set_ylim(x_axis.min() * maxband * shares.min() / 2, maxperf * 2)
+        axs.set_ylabel('Performance log([MFLOP/s])')
+    else:
+        axs.set_ylim(0, maxperf * 1.05 * shares.max())
+        axs.set_ylabel('Performance [MFLOP/s]')
+    axs.set_xlabel('Operational Intensity [FLOP/Byte]')
+    fig.savefig(name_prefix + f'_{per.capitalize()}TimeSeriesRoofline.png', bbox_inches='tight')
+    plt.close(fig)
+
+
+def summarise_regions(likwid_dir: str, maxperf: float, maxband: float, ceilings_file: str = None):
+    """
+    summarise_regions merges the outputs of the code lines that were profiled as separate regions into one table,
+    written to likwid_regions.csv in likwid_dir. The performance and bandwidth of a region are its means over its
+    samples, and its operational intensity is its total FLOP over its total bytes. Regions that ran long enough for the
+    windows of their rolling aggregates to be merged are summarised from those, weighting every window by its number
+    of samples. Regions that finished before their first sample have no values.
+
+    Parameters
+    ----------
+    likwid_dir: str = path the likwid outputs were written to, holding likwid_regions.json and for each region N
+        likwid_output_N.txt, likwid_timeline_N.arrow and likwid_aggregates_N.arrow.
+    maxperf: float = maximum performance listed in likwid output file.
+    maxband: float = maximum memory bandwidth listed in likwid output file.
+    ceilings_file: str = path to likwid_performance_out.txt, whose ceilings the regions are placed relative to.
+
+    Returns
+    -------
+    pd.DataFrame with one row per region
+    """
+    with open(likwid_dir + '/likwid_regions.json', 'r') as read_file:
+        regions = json.load(read_file)
+    names, peaks, bandwidths = roofline_ceilings(maxperf, maxband, ceilings_file)
+    rows = []
+    for region, code_line in regions.items():
+        row = {'Region': int(region), 'Code line': code_line, 'Samples': 0, 'Runtime [s]': np.nan,
+               'Performance [MFLOP/s]': np.nan, 'Bandwidth [MByte/s]': np.nan,
+               'Operational intensity [FLOP/Byte]': np.nan}
+        likwid_file = f'{likwid_dir}/likwid_output_{region}.txt'
+        timeline_file = f'{likwid_dir}/likwid_timeline_{region}.arrow'
+        aggregates_file = f'{likwid_dir}/likwid_aggregates_{region}.arrow'
+        if os.path.exists(likwid_file) and os.path.exists(timeline_file):
+            time, threads = read_thread_timeseries(likwid_file, like=('[FLOP/s]', 'Memory Bandwidth [Bytes/s]'),
+                                                   timeline_file=timeline_file, aggregates_file=aggregates_file)
+            aggregates = read_aggregates(aggregates_file)
+            # Number of samples behind every row, more than one for the windows of the aggregates
+            weights = np.ones(len(time)) if aggregates is None else aggregates.column('Samples').to_numpy()
+            flop_s = [np.nansum(values, axis=1) for name, values in threads.items() if '[FLOP/s]' in name]
+            bandwidth = [np.nansum(values, axis=1) for name, values in threads.items()
+                         if 'Memory Bandwidth [Bytes/s]' in name]
+            row['Samples'] = int(weights.sum())
+            if len(time) > 0:
+                row['Runtime [s]'] = time.max()
+            if len(time) > 0 and len(flop_s) > 0 and len(bandwidth) > 0:
+                row['Performance [MFLOP/s]'] = np.average(sum(flop_s), weights=weights) * 1.0e-6
+                row['Bandwidth [MByte/s]'] = np.average(sum(bandwidth), weights=weights) * 1.0e-6
+                if (sum(bandwidth) * weights).sum() > 0:
+                    row['Operational intensity [FLOP/Byte]'] = ((sum(flop_s) * weights).sum() /
+                                                                (sum(bandwidth) * weights).sum())
+        rows += [row]
+    summary = pd.DataFrame(rows, columns=['Region', 'Code line', 'Samples', 'Runtime [s]', 'Performance [MFLOP/s]',
+                                          'Bandwidth [MByte/s]', 'Operational intensity [FLOP/Byte]'])
+    nearest, percentages = attainable_percentages(summary['Operational intensity [FLOP/Byte]'].to_numpy(),
+                                                  summary['Performance [MFLOP/s]'].to_numpy(), peaks, bandwidths)
+    summary['Nearest ceiling'] = [names[number] if np.isfinite(percentage) else ''
+                                  for number, percentage in zip(nearest, percentages)]
+    summary['Attained [%]'] = percentages
+    summary.to_csv(likwid_dir + '/likwid_regions.csv', index=False)
+    print(summary.drop(columns='Code line').to_string(index=False))
+    return summary
+
+
+def plot_regions_roofline(summary: pd.DataFrame,
+                          name_prefix: str,
+                          maxperf: float,
+                          maxband: float,
+                          ceilings_file: str = None,
+                          log_plot: bool = False):
+    """
+    plot_regions_roofline plots every region of summarise_regions as one point on a single roofline plot, saved as
+    {name_prefix}_RegionsRoofline.png.
+    """
+    names, peaks, bandwidths = roofline_ceilings(maxperf, maxband, ceilings_file)
+    measured = summary.dropna(subset=['Performance [MFLOP/s]', 'Operational intensity [FLOP/Byte]'])
+    if maxperf / maxband > 1:
+        max_x = (maxperf / maxband) * 2
+    else:
+        max_x = 1
+    max_x = max(max_x, measured['Operational intensity [FLOP/Byte]'].max() if len(measured) > 0 else 0)
+    x_axis = roofline_axis(peaks, bandwidths, max_x * (10 if log_plot else 1.1), log_plot)
+    y = attainable(x_axis, peaks, bandwidths)
+
+    fig, axs = plt.subplots(1, 1, figsize=(10, 7))
+    fig.suptitle("Roofline Model per region", fontsize=20)
+    for number, name in enumerate(names):
+        axs.plot(x_axis, y[:, number], color='k' if number == 0 else None, linestyle='-' if number == 0 else ':',
+                 label=name)
+    for _, region in measured.iterrows():
+        code_line = region['Code line'] if len(region['Code line']) <= 40 else region['Code line'][:37] + '...'
+        axs.plot(region['Operational intensity [FLOP/Byte]'], region['Performance [MFLOP/s]'], 'o',
+                 label=f"{region['Region']}: {code_line} [~{int(region['Attained [%]'])}% of "
+                       f"{region['Nearest ceiling']}]")
+    axs.set_xlim(x_axis.min(), x_axis.max())
+    if log_plot:
+        axs.set_xscale('log')
+        axs.set_yscale('log')
+        axs.set_ylim(y[0].min() / 2, peaks.max() * 2)
+    else:
+        axs.set_ylim(0, peaks.max() * 1.1)
+    axs.set_xlabel('Operational Intensity [FLOP/Byte]')
+    axs.set_ylabel('Performance [MFLOP/s]')
+    axs.legend(loc='upper left', fontsize='small')
+    fig.savefig(name_prefix + '_RegionsRoofline.png', bbox_inches='tight')
+    plt.close(fig)
@@ -0,0 +1,78 @@
+from importlib import resources as impresources
+import itertools
+import io
+
+from . import data
+
+procstat_file_path = impresources.files(data) / "procstat_commands.txt"
+procstat_initEndSplit = -1
+
+
+def define_initialise(profilefile: io.TextIOWrapper, profilerdict: dict = None):
+    '''
+    define_initialise creates any needed variables, and writes the required arguments into the profile_file in order
+    to initialise the profiling for a user, in this case that is procstat. procstat samples the CPU, memory, disk and
+    network counters in /proc directly, rather than running a prometheus instance and node_exporter.
+
+    Parameters
+    ----------
+    profilefile: io.TextIOWrapper = Open text file that can be written to and is being used to initiate, call and
+        terminate all profiling codes that are to be executed with the user specified bash script.
+    profilerdict: dict = dictionary containing required arguments that the profiler has or other values, such as the
+        "interval" in seconds between two samples and the "batch" of samples written together.
+
+    Returns
+    -------
+    None
+    '''
+    global procstat_file_path
+    global procstat_initEndSplit
+    if profilerdict is None:
+        profilerdict = {}
+    profilefile.write('# Procstat initialisation declarations\n')
+    if 'requirements' in profilerdict.keys():
+        for i in profilerdict['requirements']:
+            profilefile.write(i)
+            profilefile.write('\n')
+    profilefile.write('\n')
+    profilefile.write('export PROCSTAT_RUNNING_DIR=${WORKING_DIR}/Procstat\n')
+    profilefile.write('export PROCSTAT_INTERVAL={}\n'.format(profilerdict['interval'] if 'interval' in
+                                                            profilerdict.keys() else 10))
+    # Number of samples written to the node-local scratch together
+    profilefile.write('export PROCSTAT_BATCH={}\n'.format(profilerdict['batch'] if 'batch' in
+                                                         profilerdict.keys() else 30))
+    sample_path = str(impresources.files(data).joinpath("fake"))[:-5]
+    profilefile.write('export PROCSTAT_SCRIPT={}\n'.format(sample_path))
+    with open(procstat_file_path, 'r') as read_file:
+        for number, line in enumerate(read_file):
+            if line == '# *=*\n':
+                procstat_initEndSplit = number + 1
+                break
+            profilefile.write(line)
+    profilefile.write('# Procstat initialisation done\n')
+    profilefile.write('\n')
+    return
+
+
+def define_end(profilefile: io.TextIOWrapper):
+    '''
+    define_end terminates the sampler that was used to profile the user specified bash script, converts its samples to
+    the layout of the prometheus data and plots them, in this case that is procstat.
+    Parameters
+    ----------
+    profilefile: io.TextIOWrapper = Open text file that can be written to and is being used to initiate, call and
+        terminate all profiling codes that are to be executed with the user specified bash script.
+
+    Returns
+    -------
+    None
+    '''
+    global procstat_file_path
+    global procstat_initEndSplit
+    profilefile.write('# Procstat final steps declarations\n')
+    with open(procstat_file_path, 'r') as read_file:
+        for line in itertools.islice(read_file, procstat_initEndSplit, None):
+            profilefile.write(line)
+    profilefile.write('# Procstat final steps done\n')
+    profilefile.write('\n')
+    return
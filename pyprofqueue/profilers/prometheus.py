@@ -1,13 +1,25 @@
-from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import PolyCollection
+from matplotlib.figure import Figure
+from matplotlib.patches import Rectangle
 from matplotlib.pyplot import cm
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdt
+from pyarrow import feather
+import pyarrow as pa
 import pandas as pd
 import numpy as np
 import pytz
+from dateutil import tz as dateutil_tz
 
 from importlib import resources as impresources
+import multiprocessing
+import json
+import os
+import re
 import itertools
+import warnings
 import io
 
 from . import data
@@ -18,12 +30,23 @@ DPI = 100
 avg_xSize, avg_ySize = 50, 10
 MeanMult = 3
 LegCols = 7
+# Above this many steps, the steps of a scatter are shaded and listed in the Gant chart by their base name
+step_group_limit = 50
+gant_row_height, gant_max_ySize = 0.4, 300
 
 tz = pytz.timezone('UTC')
+# The CWL log and files written before version 2 hold wall-clock times of the host, and plots label times in it
+local_tz = dateutil_tz.tzlocal()
 
 prometheus_file_path = impresources.files(data) / "prometheus_commands.txt"
 prometheus_initEndSplit = -1
 IP_address = None
+render_jobs = None
+cwl_interval = None
+process_interval = None
+cwl_state_version = 1
+# profilerdict keys that are passed on to read_prometheus.py, and the flags they are passed with
+scrape_option_flags = {'step': '--step', 'points': '--points', 'min_step': '--min_step', 'overview': '--overview'}
 
 
 def define_initialise(profilefile: io.TextIOWrapper, profilerdict: dict = None):
@@ -44,6 +67,8 @@ def define_initialise(profilefile: io.TextIOWrapper, profilerdict: dict = None):
     global prometheus_file_path
     global prometheus_initEndSplit
     global IP_address
+    global cwl_interval
+    global process_interval
     if 'ip_address' not in profilerdict.keys() and 'requirements' not in profilerdict.keys():
         exit("Must provide prometheus requirements list, or existing prometheus IP address, neither was given.")
     profilefile.write('# Prometheus initialisation declarations\n')
@@ -56,14 +81,22 @@ def define_initialise(profilefile: io.TextIOWrapper, profilerdict: dict = None):
         IP_address = profilerdict['ip_address']
         profilefile.write(f"export PROMETHEUS_IP={IP_address}\n")
     profilefile.write('export PROMETHEUS_RUNNING_DIR=${WORKING_DIR}/Prometheus\n')
+    # Upper limit in seconds for waiting on prometheus to be ready, and for the last scrape after the work
+    profilefile.write('export PROMETHEUS_READY_TIMEOUT={}\n'.format(profilerdict['ready_timeout'] if 'ready_timeout' in
+                                                                     profilerdict.keys() else 15))
+    scrape_options = []
+    for key, flag in scrape_option_flags.items():
+        if key in profilerdict.keys():
+            scrape_options += [f'{flag} {profilerdict[key]}']
+    profilefile.write('export PROMETHEUS_SCRAPE_OPTIONS="{}"\n'.format(' '.join(scrape_options)))
     scrape_path = str(impresources.files(data).joinpath("fake"))[:-5]
     profilefile.write('export PROFILE_SCRAPE={}\n'.format(scrape_path))
     profilefile.write('\n')
-    final_init_indicator = 1
+    final_init_indicator = 2
     if IP_address is None:
-        read_indicators = [0, 1]
+        read_indicators = [0, 1, 2]
     else:
-        read_indicators = [0]
+        read_indicators = [0, 2]
     indicator = 0
     with open(prometheus_file_path, 'r') as read_file:
         for number, line in enumerate(read_file):
@@ -76,6 +109,28 @@ def define_initialise(profilefile: io.TextIOWrapper, profilerdict: dict = None):
 
             if indicator in read_indicators:
                 profilefile.write(line)
+    if 'cwl_interval' in profilerdict.keys():
+        # Keeps the CWL step table in the Prometheus directory up to date while the job runs
+        cwl_interval = profilerdict['cwl_interval']
+        profilefile.write(f'while sleep {cwl_interval}; do\n')
+        profilefile.write('    if [ -f ${WORKING_DIR}/job_output_setup.txt ]; then\n')
+        profilefile.write('        ${PYTHON_INSTANCE} -c "import pyprofqueue.profilers.prometheus as prom; '
+                          'prom.cwl_pass(\'${WORKING_DIR}/job_output_setup.txt\', '
+                          'state_file=\'${PROMETHEUS_RUNNING_DIR}/cwl_state.json\')" > /dev/null 2>&1\n')
+        profilefile.write('    fi\n')
+        profilefile.write('done &\n')
+        profilefile.write('export PROMETHEUS_CWL_PID=$!\n')
+        profilefile.write('pyprofqueue_profiler ${PROMETHEUS_CWL_PID}\n')
+    if 'process_interval' in profilerdict.keys():
+        # Samples the processes started by this script, other than the profilers, to tell the job's own usage apart
+        process_interval = profilerdict['process_interval']
+        profilefile.write(f'export PROMETHEUS_PROCESS_INTERVAL={process_interval}\n')
+        # Written to node-local scratch like the procstat samples, the shared filesystem only gets the merged data
+        profilefile.write('export PROMETHEUS_PROCESS_SCRATCH=$(mktemp -d ${TMPDIR:-/tmp}/pyprofqueue_process.XXXXXX)\n')
+        profilefile.write('${PYTHON_INSTANCE} ${PROFILE_SCRAPE}/sample_proc.py -o "${PROMETHEUS_PROCESS_SCRATCH}" '
+                          '-i ${PROMETHEUS_PROCESS_INTERVAL} --tree $$ '
+                          '--exclude-file ${PYPROFQUEUE_PID_FILE} &\n')
+        profilefile.write('export PROMETHEUS_PROCESS_PID=$!\n')
     profilefile.write('# Prometheus initialisation done\n')
     profilefile.write('\n')
 
@@ -96,6 +151,11 @@ def define_end(profilefile: io.TextIOWrapper):
     global prometheus_file_path
     global prometheus_initEndSplit
     profilefile.write('# Prometheus final steps declarations\n')
+    if cwl_interval is not None:
+        profilefile.write('kill -TERM ${PROMETHEUS_CWL_PID}\n')
+    if process_interval is not None:
+        profilefile.write('kill -TERM ${PROMETHEUS_PROCESS_PID}\n')
+        profilefile.write('wait ${PROMETHEUS_PROCESS_PID}\n')
     if IP_address is None:
         read_indicators = [0, 1, 2]
     else:
@@ -112,93 +172,615 @@ def define_end(profilefile: io.TextIOWrapper):
 
 
 def load_df(feather_path: str):
-    df = pd.read_feather(feather_path)
-    df['Time'] = df['Time'].apply(lambda x: datetime.strptime(x, '%Y-%m-%d %H:%M:%S'))
+    '''
+    load_df reads the feather file written by read_prometheus.py into a pandas.DataFrame.
+
+    Parameters
+    ----------
+    feather_path: str = path to the scraped prometheus data.
+
+    Returns
+    -------
+    pd.DataFrame of the data, and np.array of the times at which data was collected
+    '''
+    table = feather.read_table(feather_path, memory_map=True)
+    version = feather_format(table.schema)
+    df = table.to_pandas(split_blocks=True, self_destruct=True)
+    if version < 2:
+        # Older files store the time as local time strings
+        df['Time'] = local_to_utc(df['Time'])
+    time_series = df['Time'].values
+    return df, time_series
+
+
+def load_lazy_df(feather_path: str):
+    '''
+    load_lazy_df opens the feather file written by read_prometheus.py as a LazyFrame, which memory maps the file and
+    only reads the columns that are used. This can be passed to plot_prom_profiling in place of the DataFrame of
+    load_df.
+
+    Parameters
+    ----------
+    feather_path: str = path to the scraped prometheus data.
+
+    Returns
+    -------
+    LazyFrame of the data, and np.array of the times at which data was collected
+    '''
+    df = LazyFrame(feather_path)
     time_series = df['Time'].values
     return df, time_series
 
 
-def cwl_pass(cwl_output: str):
-    df_steps = pd.DataFrame(columns=['Step', 'Start', 'End', 'Status'])
-    workflow_steps = []
-    with open(cwl_output) as f:
-        for line in f.readlines():
-            if 'starting step' in line or (
-                    '[workflow ' in line and '] start\n' in line) or (
-                    ('[step ' in line or '[workflow ' in line) and 'completed success' in line) or (
-                    ('[step ' in line or '[workflow ' in line) and 'completed skipped' in line) or (
-                    ('[step ' in line or '[workflow ' in line) and 'completed permanentFail' in line):
-                    #'completed permanentFail' in line):
-                bracketStart = [i for i, x in enumerate(line) if x == '[']
-                bracketEnd = [i for i, x in enumerate(line) if x == ']']
-                time = tz.localize(datetime.strptime(line[bracketStart[1] + 1:bracketEnd[0]], '%Y-%m-%d %H:%M:%S'))
-                if 'starting step' in line:
-                    df_steps = pd.concat(
-                        [df_steps, pd.DataFrame([{'Step': line[line.index("starting step") + 14:-1], 'Start': time}])],
-                        ignore_index=True)
-                elif '[workflow ' in line and '] start\n' in line:
-                    workflow = line[line.index("[workflow ") + 10:line.index("] start")]
-                    df_steps = pd.concat([df_steps, pd.DataFrame([{'Step': workflow, 'Start': time}])],
-                                         ignore_index=True)
-                    if len(workflow) > 1:
-                        if workflow not in workflow_steps:
-                            workflow_steps += [workflow]
-                else:
-                    if '[step ' in line:
-                        search = '[step '
-                    elif '[workflow ' in line:
-                        search = '[workflow '
-                    if 'completed success' in line:
-                        if 'workflow' in line or line[line.index('[step') + 6:bracketEnd[1]] in workflow_steps:
-                            df_steps.loc[df_steps['Step'] == line[line.index(search) + 10:bracketEnd[1]], 'End'] = time
-                            df_steps.loc[df_steps['Step'] == line[line.index(search) + 10:bracketEnd[1]], 'Status'] = 'b'
-                        else:
-                            df_steps.loc[df_steps['Step'] == line[line.index(search) + 6:bracketEnd[1]], 'End'] = time
-                            df_steps.loc[df_steps['Step'] == line[line.index(search) + 6:bracketEnd[1]], 'Status'] = 'g'
-                    elif 'completed skipped' in line:
-                        if search == '[workflow ':
-                            df_steps.loc[df_steps['Step'] == line[line.index(search) + 10:bracketEnd[1]], 'End'] = time
-                            df_steps.loc[df_steps['Step'] == line[line.index(search) + 10:bracketEnd[1]], 'Status'] = 'm'
-                        else:
-                            df_steps.loc[df_steps['Step'] == line[line.index(search) + 6:bracketEnd[1]], 'End'] = time
-                            df_steps.loc[df_steps['Step'] == line[line.index(search) + 6:bracketEnd[1]], 'Status'] = 'y'
-                    elif 'completed permanentFail' in line:
-                        if search == '[workflow ':
-                            df_steps.loc[df_steps['Step'] == line[line.index(search) + 10:bracketEnd[1]], 'End'] = time
-                            df_steps.loc[df_steps['Step'] == line[line.index(search) + 10:bracketEnd[1]], 'Status'] = 'k'
-                        else:
-                            df_steps.loc[df_steps['Step'] == line[line.index(search) + 6:bracketEnd[1]], 'End'] = time
-                            df_steps.loc[df_steps['Step'] == line[line.index(search) + 6:bracketEnd[1]], 'Status'] = 'r'
-    df_steps['Start'] = pd.to_datetime(df_steps['Start'])
-    df_steps.loc[df_steps['Status'].isnull(), 'Status'] = 'c'
-    df_steps.loc[df_steps['End'].isnull(), 'End'] = df_steps.loc[~df_steps['End'].isnull()]['End'].max()
-    df_steps['End'] = pd.to_datetime(df_steps['End'])
-    df_steps['Time'] = (df_steps['End'] - df_steps['Start']).dt.total_seconds()
-    return df_steps
-
-
-def plot_shades(df_steps: pd.DataFrame, label: bool = True):
-    for index, row in df_steps.iterrows():
-        if row['Status'] != 'b' and row['Status'] != 'm' and row['Status'] != 'c':
-            try:
-                c = next(color)
-            except:
-                color = iter(cm.terrain(np.linspace(0, 0.9, 8)))
-                c = next(color)
-            try:
-                h = next(hatch)
-            except:
-                hatch = iter(['/', '|', '-', '+', 'x', 'O', '*'])
-                h = next(hatch)
-
-            plt.vlines(row['Start'], 0, 100, colors=c, linestyle='--')
-            plt.vlines(row['End'], 0, 100, colors=c, linestyle='--')
-            if label:
-                plt.axvspan(row['Start'], row['End'] + timedelta(seconds=10), 0, 100,
-                            alpha=shade_alpha, color=c, label=row['Step'], linestyle='--', hatch=h)
+class LazyFrame:
+    """
+    Read only, DataFrame like view of a feather file written by read_prometheus.py. Columns are only read from the
+    memory mapped file when they are accessed, so memory use follows what is plotted rather than what was scraped.
+
+    Parameters to initiate
+    ----------
+    feather_path: str
+        path to the scraped prometheus data.
+
+    Notes
+    -----
+    Supports the parts of the pandas.DataFrame interface used by plot_prom_profiling: the columns attribute, len(),
+    filter(like=...) and indexing by a column name or a list of column names.
+    """
+    def __init__(self, feather_path: str):
+        self.feather_path = feather_path
+        with pa.memory_map(feather_path) as source:
+            schema = pa.ipc.open_file(source).schema
+        self.version = feather_format(schema)
+        self.columns = pd.Index(schema.names)
+
+    def __len__(self):
+        return len(self.read_columns(['Time']))
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.read_columns([key])[str(key)]
+        return self.read_columns(list(key))
+
+    def filter(self, like: str):
+        return self.read_columns([column for column in self.columns if like in column])
+
+    def read_columns(self, names: list):
+        names = [str(name) for name in names]
+        df = feather.read_table(self.feather_path, columns=names, memory_map=True).to_pandas(split_blocks=True)
+        if 'Time' in names and self.version < 2:
+            df['Time'] = local_to_utc(df['Time'])
+        return df
+
+
+def local_to_utc(times: pd.Series):
+    # Wall-clock times of the host as UTC timestamps, so they line up with the UTC times of the prometheus data
+    return pd.to_datetime(times, format='%Y-%m-%d %H:%M:%S').dt.tz_localize(local_tz).dt.tz_convert(tz)
+
+
+def feather_format(schema: pa.Schema):
+    # Files written before the layout was versioned have no pyprofqueue_format entry, and are version 1
+    metadata = schema.metadata if schema.metadata is not None else {}
+    return int(metadata.get(b'pyprofqueue_format', b'1'))
+
+
+class CWLLogParser:
+    """
+    Single pass parser of the output of a CWL run, building the table of steps returned by cwl_pass. Lines are fed one
+    at a time, so a log can be read incrementally, and each line is only scanned a fixed number of times. Steps are
+    kept in lists, with a dictionary from step name to the rows of that name, so completing a step does not search the
+    table, and the DataFrame is only built once in to_frame. The parsed steps and how far the log was read can be saved
+    to, and resumed from, a state file, so a log that is still being written only has its new lines parsed.
+
+    Parameters to initiate
+    ----------
+    cwl_output: str = Path to the text file containing the output of CWL.
+    """
+    # Pre filter for the lines that start or complete a step, the exact checks are only made for lines that match it
+    relevant_line = re.compile(r'starting step|\] start\n|completed (?:success|skipped|permanentFail)')
+    # Status of a completed step, (workflow, step)
+    status_colours = {'success': ('b', 'g'), 'skipped': ('m', 'y'), 'permanentFail': ('k', 'r')}
+
+    def __init__(self, cwl_output: str):
+        self.cwl_output = os.path.abspath(cwl_output)
+        self.offset = 0
+        self.steps = []
+        self.starts = []
+        self.ends = []
+        self.statuses = []
+        self.rows = {}
+        self.workflow_steps = []
+
+    def add_step(self, step: str, time: str):
+        self.rows.setdefault(step, []).append(len(self.steps))
+        self.steps += [step]
+        self.starts += [time]
+        self.ends += [None]
+        self.statuses += [None]
+
+    def complete_step(self, step: str, time: str, status: str):
+        for row in self.rows.get(step, []):
+            self.ends[row] = time
+            self.statuses[row] = status
+
+    def feed(self, line: str):
+        if self.relevant_line.search(line) is None:
+            return
+        starting = 'starting step' in line
+        workflow_start = '[workflow ' in line and '] start\n' in line
+        result = next((x for x in self.status_colours if 'completed ' + x in line), None)
+        if not (starting or workflow_start or (result is not None and ('[step ' in line or '[workflow ' in line))):
+            return
+        # The time stamp is found between the second '[' and the first ']' of the line
+        bracket_start = line.index('[', line.index('[') + 1)
+        bracket_end = line.index(']')
+        time = line[bracket_start + 1:bracket_end]
+        if starting:
+            self.add_step(line[line.index("starting step") + 14:-1], time)
+        elif workflow_start:
+            workflow = line[line.index("[workflow ") + 10:line.index("] start")]
+            self.add_step(workflow, time)
+            if len(workflow) > 1 and workflow not in self.workflow_steps:
+                self.workflow_steps += [workflow]
+        else:
+            search = '[step ' if '[step ' in line else '[workflow '
+            name_end = line.index(']', bracket_end + 1)
+            if result == 'success':
+                is_workflow = 'workflow' in line or line[line.index('[step') + 6:name_end] in self.workflow_steps
             else:
-                plt.axvspan(row['Start'], row['End'] + timedelta(seconds=10), 0, 100,
-                            alpha=shade_alpha, color=c, linestyle='--', hatch=h)
+                is_workflow = search == '[workflow '
+            name_start = line.index(search) + (10 if is_workflow else 6)
+            self.complete_step(line[name_start:name_end], time, self.status_colours[result][0 if is_workflow else 1])
+
+    def feed_bytes(self, line: bytes):
+        # Matches reading the log in text mode, which turns Windows line endings into '\n'
+        self.feed(line.decode(errors='replace').replace('\r\n', '\n'))
+
+    def load(self, state_file: str):
+        """
+        Resumes from a state file written by save, unless it does not exist, belongs to another log, or the log was
+        replaced or truncated since, in which case the log is parsed from the start.
+
+        Parameters
+        ----------
+        state_file: str = Path to the state file.
+        """
+        if not os.path.isfile(state_file):
+            return
+        with open(state_file) as f:
+            state = json.load(f)
+        log_stat = os.stat(self.cwl_output)
+        if state.get('version') != cwl_state_version or state['cwl_output'] != self.cwl_output or \
+                state['inode'] != log_stat.st_ino or state['offset'] > log_stat.st_size:
+            print(f"CWL state {state_file} does not match {self.cwl_output}, parsing the log from the start.")
+            return
+        self.offset = state['offset']
+        self.steps, self.starts, self.ends, self.statuses = \
+            state['steps'], state['starts'], state['ends'], state['statuses']
+        self.workflow_steps = state['workflow_steps']
+        self.rows = {}
+        for row, step in enumerate(self.steps):
+            self.rows.setdefault(step, []).append(row)
+
+    def save(self, state_file: str):
+        """
+        Writes the parsed steps and the offset up to which the log was read to state_file. The file is replaced
+        atomically, so a reader never sees a partially written state.
+
+        Parameters
+        ----------
+        state_file: str = Path to the state file.
+        """
+        state = {'version': cwl_state_version, 'cwl_output': self.cwl_output,
+                 'inode': os.stat(self.cwl_output).st_ino, 'offset': self.offset,
+                 'steps': self.steps, 'starts': self.starts, 'ends': self.ends, 'statuses': self.statuses,
+                 'workflow_steps': self.workflow_steps}
+        temporary_file = f'{state_file}.{os.getpid()}.tmp'
+        with open(temporary_file, 'w') as f:
+            json.dump(state, f)
+        os.replace(temporary_file, state_file)
+
+    def to_frame(self):
+        df_steps = pd.DataFrame({'Step': pd.Series(self.steps, dtype=object),
+                                 'Start': local_to_utc(pd.Series(self.starts, dtype=object)),
+                                 'End': local_to_utc(pd.Series(self.ends, dtype=object)),
+                                 'Status': pd.Series(self.statuses, dtype=object)})
+        df_steps.loc[df_steps['Status'].isnull(), 'Status'] = 'c'
+        df_steps.loc[df_steps['End'].isnull(), 'End'] = df_steps['End'].max()
+        df_steps['Time'] = (df_steps['End'] - df_steps['Start']).dt.total_seconds()
+        return df_steps
+
+
+def cwl_pass(cwl_output: str, state_file: str = None):
+    parser = CWLLogParser(cwl_output)
+    if state_file is not None:
+        parser.load(state_file)
+    # Only complete lines are consumed, a line that is still being written is parsed again on the next pass
+    tail = b''
+    with open(cwl_output, 'rb') as f:
+        f.seek(parser.offset)
+        for line in f:
+            if not line.endswith(b'\n'):
+                tail = line
+                break
+            parser.feed_bytes(line)
+            parser.offset += len(line)
+    if state_file is not None:
+        parser.save(state_file)
+    if tail:
+        parser.feed_bytes(tail)
+    return parser.to_frame()
+
+
+class MetricFamilies:
+    """
+    Index of the column families of a prometheus DataFrame, i.e. 'CPU Usage:' or 'Write:'. The columns of a family are
+    read once into a contiguous numpy block, and aggregates over the family are computed once, so every plot made from
+    the same DataFrame reuses them instead of filtering and copying the DataFrame again.
+
+    Parameters to initiate
+    ----------
+    df: pd.DataFrame
+        DataFrame or LazyFrame of the prometheus profiling data.
+    """
+    def __init__(self, df):
+        self.df = df
+        self.family_columns = {}
+        self.blocks = {}
+        self.aggregates = {}
+
+    def columns(self, family: str):
+        # Same matching as df.filter(like=family)
+        if family not in self.family_columns:
+            self.family_columns[family] = [column for column in self.df.columns if family in column]
+        return self.family_columns[family]
+
+    def block(self, family: str):
+        # (time, column) block of every column of the family, in the order of columns(family)
+        if family not in self.blocks:
+            columns = self.columns(family)
+            if len(columns) > 0:
+                self.blocks[family] = np.ascontiguousarray(self.df[columns].to_numpy(dtype=np.float64))
+            else:
+                self.blocks[family] = np.empty((len(self.df), 0))
+        return self.blocks[family]
+
+    def column(self, family: str, name: str):
+        return self.block(family)[:, self.columns(family).index(name)]
+
+    def mean(self, family: str):
+        # Mean over the columns of the family at each time stamp, ignoring missing samples
+        return self.aggregate(family, 'mean', lambda block: np.nanmean(block, axis=1))
+
+    def column_mean(self, family: str):
+        return self.aggregate(family, 'column_mean', lambda block: np.nanmean(block, axis=0))
+
+    def column_max(self, family: str):
+        return self.aggregate(family, 'column_max', lambda block: np.nanmax(block, axis=0))
+
+    def warm(self, family: str, aggregates: list = ()):
+        # Reads the block of the family and computes the named aggregates now, i.e. before forking workers that
+        # would each compute them again
+        self.block(family)
+        for name in aggregates:
+            getattr(self, name)(family)
+
+    def aggregate(self, family: str, name: str, function):
+        if (family, name) not in self.aggregates:
+            with warnings.catch_warnings():
+                # All missing rows or columns are left as NaN, as pandas does
+                warnings.simplefilter('ignore', category=RuntimeWarning)
+                self.aggregates[(family, name)] = function(self.block(family))
+        return self.aggregates[(family, name)]
+
+
+def envelope_indices(values: np.array, width: int):
+    """
+    Indices of the samples needed to draw a series at a width of width pixels without visible change. The samples are
+    split into width bins, and of every bin the samples holding the minimum and maximum are kept, as well as the first
+    gap (NaN) so that missing data still shows. The first and last sample are always kept.
+
+    Parameters
+    ----------
+    values: np.array = Series to be plotted, or 2D array with one series per column, in which case the union of the
+                       indices needed by every series is returned, so that bands between them can still be filled.
+    width: int = Number of pixels the series is drawn across.
+    """
+    values = np.asarray(values, dtype=float)
+    if values.ndim == 1:
+        values = values[:, None]
+    n_samples = values.shape[0]
+    bin_size = -(-n_samples // max(int(width), 1))
+    if bin_size <= 2:
+        return np.arange(n_samples)
+    n_bins = n_samples // bin_size
+    binned = values[:n_bins * bin_size].reshape(n_bins, bin_size, values.shape[1])
+    gaps = np.isnan(binned)
+    offsets = (np.arange(n_bins) * bin_size)[:, None]
+    indices = [np.where(gaps, np.inf, binned).argmin(axis=1) + offsets,
+               np.where(gaps, -np.inf, binned).argmax(axis=1) + offsets,
+               (gaps.argmax(axis=1) + offsets)[gaps.any(axis=1)],
+               np.arange(n_bins * bin_size, n_samples), np.array([0, n_samples - 1])]
+    return np.unique(np.concatenate([x.ravel() for x in indices]))
+
+
+def step_base_names(steps: pd.Series):
+    # Scattered CWL steps are named <step>_<n>, and nested scatters <step>_<n>_<m>
+    return steps.str.replace(r'(_\d+)+$', '', regex=True)
+
+
+def group_steps(df_steps: pd.DataFrame):
+    """
+    Merges the steps sharing a base name, see step_base_names, into a single step spanning from the first start to the
+    last end of the group. Used when a workflow has more steps than can be shown individually.
+
+    Parameters
+    ----------
+    df_steps: pd.DataFrame = Table of steps, as returned by cwl_pass.
+    """
+    grouped = df_steps.assign(Step=step_base_names(df_steps['Step'])).groupby('Step', sort=False)
+    return pd.DataFrame({'Start': grouped['Start'].min(), 'End': grouped['End'].max(),
+                         'Status': grouped['Status'].first()}).reset_index()
+
+
+def plot_shades(df_steps: pd.DataFrame, label: bool = True, ax=None):
+    if ax is None:
+        ax = plt.gca()
+    shaded = df_steps.loc[~df_steps['Status'].isin(['b', 'm', 'c'])]
+    if len(shaded) > step_group_limit:
+        shaded = group_steps(shaded)
+    if len(shaded) == 0:
+        return
+    # Steps cycle through the same colours and hatches as before, but are drawn as one collection per hatch
+    colours = cm.terrain(np.linspace(0, 0.9, 8))[np.arange(len(shaded)) % 8]
+    hatches = np.array(['/', '|', '-', '+', 'x', 'O', '*'])[np.arange(len(shaded)) % 7]
+    starts = mdt.date2num(shaded['Start'])
+    ends = mdt.date2num(shaded['End'])
+
+    ax.vlines(np.concatenate([starts, ends]), 0, 100, colors=np.concatenate([colours, colours]), linestyle='--')
+    span_ends = ends + 10 / 86400
+    for hatch in np.unique(hatches):
+        rows = np.flatnonzero(hatches == hatch)
+        spans = np.stack([np.stack([starts[rows], np.zeros(len(rows))], axis=1),
+                          np.stack([starts[rows], np.ones(len(rows))], axis=1),
+                          np.stack([span_ends[rows], np.ones(len(rows))], axis=1),
+                          np.stack([span_ends[rows], np.zeros(len(rows))], axis=1)], axis=1)
+        # x in data and y in axes coordinates, so the spans cover the full height like axvspan
+        ax.add_collection(PolyCollection(spans, facecolors=colours[rows], edgecolors=colours[rows], hatch=hatch,
+                                         alpha=shade_alpha, linestyle='--',
+                                         transform=ax.get_xaxis_transform()), autolim=False)
+    if label:
+        # Empty patches that only provide the legend entries of the steps
+        for number, step in enumerate(shaded['Step']):
+            ax.add_patch(Rectangle((starts[number], 0), 0, 0, facecolor=colours[number], edgecolor=colours[number],
+                                   hatch=hatches[number], alpha=shade_alpha, linestyle='--', label=step,
+                                   transform=ax.get_xaxis_transform()))
+
+
+def new_figure(title: str, df_steps: pd.DataFrame = None, label: bool = True, figsize: tuple = None):
+    # Figures are drawn on their own Agg canvas, so no pyplot state is shared between figures or processes
+    figure = Figure(figsize=(avg_xSize, avg_ySize) if figsize is None else figsize)
+    FigureCanvasAgg(figure)
+    figure.suptitle(title, fontsize=20)
+    ax = figure.add_subplot()
+    ax.xaxis.set_major_formatter(mdt.DateFormatter('%y-%m-%d %T', tz=local_tz))
+    ax.yaxis.set_major_formatter('{x:.04f}')
+    if df_steps is not None:
+        plot_shades(df_steps, label, ax=ax)
+    return figure, ax
+
+
+def save_figure(figure: Figure, ax, time_series: np.array, ylabel: str, file_name: str):
+    ax.legend(ncol=LegCols, prop={'size': 20}, framealpha=1, bbox_to_anchor=(0.5, -0.1), loc='upper center')
+    ax.set_xlim([time_series[0], time_series[-1]])
+    ax.set_xlabel("Time", fontsize=20)
+    ax.tick_params(axis='x', labelsize=20)
+    ax.set_ylabel(ylabel, fontsize=20)
+    ax.tick_params(axis='y', labelsize=20)
+    figure.savefig(file_name, bbox_inches='tight', dpi=DPI)
+    figure.clear()
+
+
+def plot_mean_cpu(families: MetricFamilies, time_series: np.array, name_prefix: str, df_steps: pd.DataFrame = None,
+                  label: bool = True, downsample: bool = True):
+    figure, ax = new_figure("Mean CPU usage (Percentage)", df_steps, label)
+    ax.hlines(y=100, linestyle='--', xmin=time_series[0], xmax=time_series[-1], alpha=0.25)
+    mean_usage = families.mean('CPU Usage:')
+    mean_iowait = families.mean('CPU IO Wait:')
+    times = time_series
+    if downsample:
+        kept = envelope_indices(np.column_stack([mean_usage - mean_iowait, mean_usage]), avg_xSize * DPI)
+        times, mean_usage, mean_iowait = time_series[kept], mean_usage[kept], mean_iowait[kept]
+    ax.fill_between(times, mean_usage - mean_iowait,
+                    0, label="Mean CPU usage", linestyle='-', alpha=main_alpha)
+    if np.nansum(families.column_mean('CPU IO Wait:')) > 0.1:
+        ax.fill_between(times, mean_usage, mean_usage - mean_iowait,
+                        label="Mean CPU IO Wait", linestyle='-', alpha=main_alpha, color='red')
+    ax.set_ylim([0, 102])
+    save_figure(figure, ax, time_series, "CPU usage (%)", name_prefix + '_MeanCPU_Usage.png')
+
+
+def cpu_nodes(families: MetricFamilies):
+    # Nodes of the CPU columns of jobs scraped on several nodes, named 'CPU Usage: <node>/<cpu>', in order of name
+    return sorted({column[11:].rsplit('/', 1)[0] for column in families.columns('CPU Usage:') if '/' in column})
+
+
+def cpu_sort_key(column: str):
+    # Orders CPU columns by node and then by CPU number, i.e. 'CPU Usage: node01/10' after 'CPU Usage: node01/9'
+    node, _, cpu = column[11:].rpartition('/')
+    return node, int(cpu)
+
+
+def plot_all_cpu(families: MetricFamilies, time_series: np.array, name_prefix: str, downsample: bool = True,
+                 node: str = None):
+    # With node given, only the CPUs of that node are plotted, into a figure named after the node
+    Usage_columns = families.columns('CPU Usage:')
+    if node is not None:
+        Usage_columns = [x for x in Usage_columns if x[11:].rsplit('/', 1)[0] == node]
+    N_Cores = len(Usage_columns)
+    sub_xSize, sub_ySize = 20, 15
+    N_rows = 8
+    N_columns = int(N_Cores / N_rows)
+    Yscaling = 0.95
+    Xscaling = 0.99
+
+    AllCPU = Figure(figsize=(sub_xSize, sub_ySize))
+    FigureCanvasAgg(AllCPU)
+    AllCPU.suptitle("Individual CPU usage (Percentage)" + ("" if node is None else f" of {node}"), fontsize=20)
+    sorted_columns = sorted(Usage_columns, key=cpu_sort_key)
+    iowait_max = families.column_max('CPU IO Wait:')
+    for i, cpuUsage in enumerate(sorted_columns):
+        row, col = np.abs((i // N_columns) - N_rows), i % N_columns
+        location = [((col) / N_columns) * Xscaling + 0.005, (row - 1) / N_rows * Yscaling + 0.01,
+                    1 / (N_columns) * Xscaling, (1 / N_rows) * Yscaling]
+        ax = AllCPU.add_axes(location)
+        title = cpuUsage[10:] if node is None else cpuUsage[12 + len(node):]
+        cpu_number = cpuUsage[9:]
+        ax.set_title(title, y=1.0, pad=-14)
+        ax.xaxis.set_major_formatter(mdt.DateFormatter('%d-%T', tz=local_tz))
+        ax.hlines(y=100, linestyle='--', xmin=time_series[0], xmax=time_series[-1], alpha=0.25)
+        usage = families.column('CPU Usage:', cpuUsage)
+        iowait = families.column('CPU IO Wait:', 'CPU IO Wait' + cpu_number)
+        times = time_series
+        if downsample:
+            kept = envelope_indices(np.column_stack([usage - iowait, usage]), sub_xSize * DPI / N_columns)
+            times, usage, iowait = time_series[kept], usage[kept], iowait[kept]
+        ax.fill_between(times, usage - iowait,
+                        y2=0, label=cpuUsage, linestyle='-', alpha=main_alpha)
+        if iowait_max[families.columns('CPU IO Wait:').index('CPU IO Wait' + cpu_number)] > 0.1:
+            ax.fill_between(times, usage, usage - iowait,
+                            label=cpuUsage, linestyle='-', alpha=main_alpha, color='red')
+        ax.set_ylim([0, 105])
+        ax.set_xlim([time_series[0], time_series[-1]])
+        ax.yaxis.set_visible(False)
+        ax.xaxis.set_visible(False)
+    AllCPU.savefig(name_prefix + '_AllCPU_Usages' + ('' if node is None else '_' + node) + '.png',
+                   bbox_inches='tight', dpi=DPI)
+    AllCPU.clear()
+
+
+def plot_memory(families: MetricFamilies, time_series: np.array, name_prefix: str, df_steps: pd.DataFrame = None,
+                label: bool = True, downsample: bool = True):
+    figure, ax = new_figure("RAM usage [GB]", df_steps, label)
+    memory_usage = families.column('Memory Usage [GB]', 'Memory Usage [GB]')
+    kept = envelope_indices(memory_usage, avg_xSize * DPI) if downsample else slice(None)
+    ax.fill_between(time_series[kept], memory_usage[kept], 0, label="RAM usage [GB]", linestyle='-', alpha=main_alpha)
+    ax.set_ylim([0, np.nanmax(memory_usage)*1.2])
+    save_figure(figure, ax, time_series, "RAM usage [GB]", name_prefix + '_Memory_Usage.png')
+
+
+def plot_in_out(families: MetricFamilies, time_series: np.array, file_name: str, title: str, ylabel: str,
+                positive: str, negative: str, df_steps: pd.DataFrame = None, label: bool = True,
+                three_mean: bool = False, downsample: bool = True):
+    # Plots the columns of the positive family above zero and those of the negative family below it
+    figure, ax = new_figure(title, df_steps, label)
+    limits = []
+    for family, sign in [(positive, 1), (negative, -1)]:
+        limit = 0
+        for number, column in enumerate(families.columns(family)):
+            values = families.block(family)[:, number]
+            kept = envelope_indices(values, avg_xSize * DPI) if downsample else slice(None)
+            ax.fill_between(time_series[kept], sign * values[kept], 0, label=column, linestyle='-', alpha=main_alpha)
+            if three_mean:
+                limit = families.column_mean(family)[number] * 3
+            elif limit < families.column_max(family)[number]:
+                limit = families.column_max(family)[number]
+        limits += [limit]
+    ax.vlines(0, time_series.min(), time_series.max())
+    ax.set_ylim([-limits[1] * 1.25, limits[0] * 1.25])
+    save_figure(figure, ax, time_series, ylabel, file_name)
+
+
+def plot_io(families: MetricFamilies, time_series: np.array, name_prefix: str, df_steps: pd.DataFrame = None,
+            label: bool = True, downsample: bool = True):
+    plot_in_out(families, time_series, name_prefix + '_IO_Usage.png',
+                "IO usage [Write positive, Read negative kB]", "IO usage kB", 'Write:', 'Read:',
+                df_steps=df_steps, label=label, downsample=downsample)
+
+
+def plot_network(families: MetricFamilies, time_series: np.array, name_prefix: str, df_steps: pd.DataFrame = None,
+                 label: bool = True, network_three_mean: bool = True, downsample: bool = True):
+    plot_in_out(families, time_series, name_prefix + '_Network_Usage.png',
+                "Network usage [Received positive, Sent negative kB]", "Network usage kB", 'Received:', 'Sent:',
+                df_steps=df_steps, label=label, three_mean=network_three_mean, downsample=downsample)
+
+
+def plot_process(families: MetricFamilies, time_series: np.array, name_prefix: str, df_steps: pd.DataFrame = None,
+                 label: bool = True, downsample: bool = True):
+    # CPU, memory and IO of the work's own processes, stacked over each other on one time axis
+    figure = Figure(figsize=(avg_xSize, 3 * avg_ySize))
+    FigureCanvasAgg(figure)
+    figure.suptitle("Usage of the processes of the job", fontsize=20)
+    panels = [("CPU usage [cores]", [('Process CPU Usage [cores]', 1)]),
+              ("Memory [GB]", [('Process Memory [GB]', 1)]),
+              ("IO [Write positive, Read negative GB/s]", [('Process Write [GB/s]', 1), ('Process Read [GB/s]', -1)])]
+    axes = figure.subplots(len(panels), 1, sharex=True)
+    for number, (ylabel, columns) in enumerate(panels):
+        ax = axes[number]
+        ax.xaxis.set_major_formatter(mdt.DateFormatter('%y-%m-%d %T', tz=local_tz))
+        if df_steps is not None:
+            plot_shades(df_steps, label and number == 0, ax=ax)
+        limits = []
+        for column, sign in columns:
+            values = families.column(column, column)
+            kept = envelope_indices(values, avg_xSize * DPI) if downsample else slice(None)
+            ax.fill_between(time_series[kept], sign * values[kept], 0, linestyle='-', alpha=main_alpha,
+                            label=f"{column}, peak {np.nanmax(values):.2f}, mean {np.nanmean(values):.2f}")
+            limits += [sign * np.nanmax(values) * 1.2]
+        ax.set_ylim([min(limits + [0]), max(max(limits + [0]), 1e-3)])
+        ax.legend(prop={'size': 20}, framealpha=1, loc='upper left')
+        ax.set_ylabel(ylabel, fontsize=20)
+        ax.tick_params(axis='y', labelsize=20)
+    axes[-1].set_xlim([time_series[0], time_series[-1]])
+    axes[-1].set_xlabel("Time", fontsize=20)
+    axes[-1].tick_params(axis='x', labelsize=20)
+    figure.savefig(name_prefix + '_Process_Usage.png', bbox_inches='tight', dpi=DPI)
+    figure.clear()
+
+
+def plot_gant(df_steps: pd.DataFrame, time_series: np.array, name_prefix: str):
+    rows = df_steps['Step']
+    if rows.nunique() > step_group_limit:
+        # Every step is still drawn, but the steps of a scatter share the row of their base name
+        rows = step_base_names(rows)
+    # Rows in order of first appearance, as barh placed the step names
+    row_numbers, names = pd.factorize(rows)
+    Gant_figure = Figure(figsize=(avg_xSize, min(max(avg_ySize, len(names) * gant_row_height), gant_max_ySize)))
+    FigureCanvasAgg(Gant_figure)
+    Gant_figure.suptitle("Gant Chart", fontsize=20)
+    ax = Gant_figure.add_subplot()
+    ax.xaxis.set_major_formatter(mdt.DateFormatter('%y-%m-%d %T', tz=local_tz))
+    starts = mdt.date2num(df_steps['Start'])
+    ends = mdt.date2num(df_steps['End']) + 0.001
+    bars = np.stack([np.stack([starts, row_numbers - 0.4], axis=1), np.stack([starts, row_numbers + 0.4], axis=1),
+                     np.stack([ends, row_numbers + 0.4], axis=1), np.stack([ends, row_numbers - 0.4], axis=1)], axis=1)
+    ax.add_collection(PolyCollection(bars, facecolors=list(df_steps['Status']), linewidths=0))
+    ax.set_yticks(np.arange(len(names)), names)
+    ax.set_ylim([-0.5, len(names) - 0.5])
+    ax.set_xlabel("Time", fontsize=20)
+    ax.tick_params(axis='x', labelsize=20)
+    ax.set_xlim([time_series[0], time_series[-1]])
+    ax.set_ylabel("Step", fontsize=20)
+    ax.tick_params(axis='y', labelsize=20)
+    Gant_figure.savefig(name_prefix + '_StepGant.png', bbox_inches='tight', dpi=DPI)
+    Gant_figure.clear()
+
+
+def render_figure(number: int):
+    # Runs in a forked worker of plot_prom_profiling, the figures to render are inherited through render_jobs
+    function, kwargs = render_jobs[number]
+    function(**kwargs)
+
+
+# Families each figure reads and the aggregates over them it uses, warmed before the figures are rendered in parallel
+in_out_aggregates = ['column_mean', 'column_max']
+figure_families = {plot_mean_cpu: {'CPU Usage:': ['mean'], 'CPU IO Wait:': ['mean', 'column_mean']},
+                   plot_all_cpu: {'CPU Usage:': [], 'CPU IO Wait:': ['column_max']},
+                   plot_memory: {'Memory Usage [GB]': []},
+                   plot_io: {'Write:': in_out_aggregates, 'Read:': in_out_aggregates},
+                   plot_network: {'Received:': in_out_aggregates, 'Sent:': in_out_aggregates},
+                   plot_process: {'Process CPU Usage [cores]': [], 'Process Memory [GB]': [],
+                                  'Process Write [GB/s]': [], 'Process Read [GB/s]': []}}
 
 
 def plot_prom_profiling(df: pd.DataFrame,
@@ -212,162 +794,51 @@ def plot_prom_profiling(df: pd.DataFrame,
                         network_three_mean: bool = True,
                         gant: bool = True,
                         cwl_file: str = None,
-                        label: bool = True):
+                        label: bool = True,
+                        processes: int = 1,
+                        downsample: bool = True,
+                        cwl_state: str = None,
+                        process_tree: bool = True,
+                        facet_nodes: bool = True):
+    global render_jobs
+    df_steps = None
     if cwl_file is not None:
-        df_steps = cwl_pass(cwl_file)
-    # Mean CPU
+        df_steps = cwl_pass(cwl_file, cwl_state)
+    families = MetricFamilies(df)
+    shaded = {'df_steps': df_steps, 'label': label}
+    common = {'families': families, 'time_series': time_series, 'name_prefix': name_prefix, 'downsample': downsample}
+    jobs = []
     if mean_cpu:
-        MeanCPU_figure = plt.figure(figsize=(avg_xSize, avg_ySize))
-        MeanCPU_figure.suptitle("Mean CPU usage (Percentage)", fontsize=20)
-        plt.gca().xaxis.set_major_formatter(mdt.DateFormatter('%y-%m-%d %T'))
-        plt.gca().yaxis.set_major_formatter('{x:.04f}')
-        if cwl_file is not None:
-            plot_shades(df_steps, label)
-        plt.hlines(y=100, linestyle='--', xmin=time_series[0],
-                   xmax=time_series[-1], alpha=0.25)
-        plt.fill_between(time_series,
-                         df[df.filter(like='CPU Usage:').columns].mean(axis='columns') -
-                         df[df.filter(like='CPU IO Wait:').columns].mean(axis='columns'),
-                         0, label="Mean CPU usage", linestyle='-', alpha=main_alpha)
-        if df[df.filter(like='CPU IO Wait:').columns].mean().sum() > 0.1:
-            plt.fill_between(time_series,
-                             df[df.filter(like='CPU Usage:').columns].mean(axis='columns'),
-                             df[df.filter(like='CPU Usage:').columns].mean(axis='columns') -
-                             df[df.filter(like='CPU IO Wait:').columns].mean(axis='columns'),
-                             label="Mean CPU IO Wait", linestyle='-', alpha=main_alpha, color='red')
-        plt.ylim([0, 102])
-        plt.xlim([time_series[0], time_series[-1]])
-        plt.legend(ncol=LegCols, prop={'size': 20}, framealpha=1, bbox_to_anchor=(0.5, -0.1), loc='upper center')
-        plt.xlabel("Time", fontsize=20)
-        plt.xticks(fontsize=20)
-        plt.ylabel("CPU usage (%)", fontsize=20)
-        plt.yticks(fontsize=20)
-        plt.savefig(name_prefix + '_MeanCPU_Usage.png', bbox_inches='tight', dpi=DPI)
-    # All CPUs
-    if all_cpu:
-        N_Cores = len(df.filter(like='CPU Usage:').columns)
-        sub_xSize, sub_ySize = 20, 15
-        N_rows = 8
-        N_columns = int(N_Cores / N_rows)
-        Yscaling = 0.95
-        Xscaling = 0.99
-
-        AllCPU = plt.figure(figsize=(sub_xSize, sub_ySize))
-        AllCPU.suptitle("Individual CPU usage (Percentage)", fontsize=20)
-        cpuNumber = np.array([int(x[-2:]) for x in df.filter(like='CPU Usage:').columns.array])
-        Usage_columns = df.filter(like='CPU Usage:').columns.array
-        sorted_columns = np.array([x for _, x in sorted(zip(cpuNumber, Usage_columns))])
-        for i, cpuUsage in enumerate(sorted_columns):
-            row, col = np.abs((i // N_columns) - N_rows), i % N_columns
-            location = [((col) / N_columns) * Xscaling + 0.005, (row - 1) / N_rows * Yscaling + 0.01,
-                        1 / (N_columns) * Xscaling, (1 / N_rows) * Yscaling]
-            ax = AllCPU.add_axes(location)
-            title = cpuUsage[10:]
-            cpu_number = cpuUsage[9:]
-            ax.set_title(title, y=1.0, pad=-14)
-            ax.xaxis.set_major_formatter(mdt.DateFormatter('%d-%T'))
-            ax.hlines(y=100, linestyle='--', xmin=time_series[0], xmax=time_series[-1], alpha=0.25)
-            ax.fill_between(time_series, df[cpuUsage] - df['CPU IO Wait' + cpu_number],
-                            y2=0, label=cpuUsage, linestyle='-', alpha=main_alpha)
-            if df['CPU IO Wait' + cpu_number].max() > 0.1:
-                ax.fill_between(time_series, df[cpuUsage],
-                                df[cpuUsage] - df['CPU IO Wait' + cpu_number],
-                                label=cpuUsage, linestyle='-', alpha=main_alpha, color='red')
-            ax.set_ylim([0, 105])
-            ax.set_xlim([time_series[0], time_series[-1]])
-            ax.yaxis.set_visible(False)
-            ax.xaxis.set_visible(False)
-            # ax.locator_params(axis='x', nbins=4)
-        plt.savefig(name_prefix + '_AllCPU_Usages.png', bbox_inches='tight', dpi=DPI)
-    # Memory Plots
+        jobs += [(plot_mean_cpu, common | shaded)]
+    if all_cpu and facet_nodes and len(cpu_nodes(families)) > 0:
+        jobs += [(plot_all_cpu, common | {'node': node}) for node in cpu_nodes(families)]
+    elif all_cpu:
+        jobs += [(plot_all_cpu, common)]
     if memory:
-        memory_figure = plt.figure(figsize=(avg_xSize, avg_ySize))
-        memory_figure.suptitle("RAM usage [GB]", fontsize=20)
-        plt.gca().xaxis.set_major_formatter(mdt.DateFormatter('%y-%m-%d %T'))
-        plt.gca().yaxis.set_major_formatter('{x:.04f}')
-        if cwl_file is not None:
-            plot_shades(df_steps, label)
-        plt.fill_between(time_series, df['Memory Usage [GB]'], 0, label="RAM usage [GB]", linestyle='-', alpha=main_alpha)
-        plt.legend(ncol=LegCols, prop={'size': 20}, framealpha=1, bbox_to_anchor=(0.5, -0.1), loc='upper center')
-        plt.ylim([0, df['Memory Usage [GB]'].max()*1.2])
-        plt.xlim([time_series[0], time_series[-1]])
-        plt.xlabel("Time", fontsize=20)
-        plt.xticks(fontsize=20)
-        plt.ylabel("RAM usage [GB]", fontsize=20)
-        plt.yticks(fontsize=20)
-        plt.savefig(name_prefix + '_Memory_Usage.png', bbox_inches='tight', dpi=DPI)
-    # IO Plots
+        jobs += [(plot_memory, common | shaded)]
     if io_plot:
-        IO_figure = plt.figure(figsize=(avg_xSize, avg_ySize))
-        IO_figure.suptitle("IO usage [Write positive, Read negative kB]", fontsize=20)
-        plt.gca().xaxis.set_major_formatter(mdt.DateFormatter('%y-%m-%d %T'))
-        plt.gca().yaxis.set_major_formatter('{x:.04f}')
-        if cwl_file is not None:
-            plot_shades(df_steps, label)
-        maxY = 0
-        minY = 0
-        for column in df.filter(like='Write:').columns:
-            plt.fill_between(time_series, df[column], 0, label=column, linestyle='-', alpha=main_alpha)
-            if maxY < df[column].max():
-                maxY = df[column].max()
-        for column in df.filter(like='Read:').columns:
-            plt.fill_between(time_series, -df[column], 0, label=column, linestyle='-', alpha=main_alpha)
-            if minY < df[column].max():
-                minY = df[column].max()
-        plt.vlines(0, time_series.min(), time_series.max())
-        plt.ylim([-minY * 1.25, maxY * 1.25])
-        plt.legend(ncol=LegCols, prop={'size': 20}, framealpha=1, bbox_to_anchor=(0.5, -0.1), loc='upper center')
-        plt.xlim([time_series[0], time_series[-1]])
-        plt.xlabel("Time", fontsize=20)
-        plt.xticks(fontsize=20)
-        plt.ylabel("IO usage kB", fontsize=20)
-        plt.yticks(fontsize=20)
-        plt.savefig(name_prefix + '_IO_Usage.png', bbox_inches='tight', dpi=DPI)
-    # Network Plots
+        jobs += [(plot_io, common | shaded)]
     if network:
-        network_figure = plt.figure(figsize=(avg_xSize, avg_ySize))
-        network_figure.suptitle("Network usage [Received positive, Sent negative kB]", fontsize=20)
-        plt.gca().xaxis.set_major_formatter(mdt.DateFormatter('%y-%m-%d %T'))
-        plt.gca().yaxis.set_major_formatter('{x:.04f}')
-        if cwl_file is not None:
-            plot_shades(df_steps, label)
-        maxY = 0
-        minY = 0
-        for column in df.filter(like='Received:').columns:
-            plt.fill_between(time_series, df[column], 0, label=column, linestyle='-', alpha=main_alpha)
-            if network_three_mean:
-                maxY = df[column].mean() * 3
-            else:
-                if maxY < df[column].max():
-                    maxY = df[column].max()
-        for column in df.filter(like='Sent:').columns:
-            plt.fill_between(time_series, -df[column], 0, label=column, linestyle='-', alpha=main_alpha)
-            if network_three_mean:
-                minY = df[column].mean() * 3
-            else:
-                if minY < df[column].max():
-                    minY = df[column].max()
-        plt.vlines(0, time_series.min(), time_series.max())
-        plt.ylim([-minY * 1.25, maxY * 1.25])
-        plt.legend(ncol=LegCols, prop={'size': 20}, framealpha=1, bbox_to_anchor=(0.5, -0.1), loc='upper center')
-        plt.xlim([time_series[0], time_series[-1]])
-        plt.xlabel("Time", fontsize=20)
-        plt.xticks(fontsize=20)
-        plt.ylabel("Network usage kB", fontsize=20)
-        plt.yticks(fontsize=20)
-        plt.savefig(name_prefix + '_Network_Usage.png', bbox_inches='tight', dpi=DPI)
-    # Gant Plot
-    if gant and cwl_file is not None:
-        Gant_figure = plt.figure(figsize=(50, 100))
-        Gant_figure.suptitle("Gant Chart", fontsize=20)
-        plt.gca().xaxis.set_major_formatter(mdt.DateFormatter('%y-%m-%d %T'))
-        plt.barh(y=df_steps['Step'],
-                 width=(mdt.date2num(df_steps['End']) - mdt.date2num(df_steps['Start']) + 0.001),
-                 left=mdt.date2num(df_steps['Start']), color=df_steps['Status'])
-        plt.xlabel("Time", fontsize=20)
-        plt.xticks(fontsize=20)
-        plt.xlim([time_series[0], time_series[-1]])
-        plt.ylabel("Step", fontsize=20)
-        plt.yticks(fontsize=20)
-        plt.savefig(name_prefix + '_StepGant.png', bbox_inches='tight', dpi=DPI)
+        jobs += [(plot_network, common | shaded | {'network_three_mean': network_three_mean})]
+    if process_tree and len(families.columns('Process CPU Usage [cores]')) > 0:
+        jobs += [(plot_process, common | shaded)]
+    if gant and df_steps is not None:
+        jobs += [(plot_gant, {'df_steps': df_steps, 'time_series': time_series, 'name_prefix': name_prefix})]
+
+    if processes > 1 and len(jobs) > 1:
+        # The blocks and aggregates are built here once, as the cache of a forked worker is lost when it exits
+        for function, kwargs in jobs:
+            for family, aggregates in figure_families.get(function, {}).items():
+                families.warm(family, aggregates)
+        # Forked workers inherit the data instead of having it pickled to them, and each renders whole figures
+        render_jobs = jobs
+        try:
+            with ProcessPoolExecutor(max_workers=min(processes, len(jobs)),
+                                     mp_context=multiprocessing.get_context('fork')) as executor:
+                list(executor.map(render_figure, range(len(jobs))))
+        finally:
+            render_jobs = None
+    else:
+        for function, kwargs in jobs:
+            function(**kwargs)
     return
@@ -3,6 +3,8 @@ import importlib
 import sys
 import os
 
+from . import overhead
+
 
 class Script:
     """
@@ -407,7 +409,9 @@ class Script:
         if bash_options is None:
             bash_options = ['']
 
-        if self.work_script is not None and any('code_line' in x for x in self.profiling) and self.read_queue_system is not None:
+        # Profilers that only profile some code lines write their calls into the temporary work script
+        if (self.work_script is not None and self.profiling is not None and
+                any('code_lines' in x.keys() for x in self.profiling.values())):
             self.create_workfile()
 
         with open(self.tmp_profile_script, mode='w') as profilefile:
@@ -422,6 +426,11 @@ class Script:
                         core_count = core_count.replace(value_queue, key_queue)
                 profilefile.write('export WORKING_DIR={}\n'.format(self.work_dir))
                 profilefile.write(f"export CPU_PER_TASK={core_count}\n")
+                if 'parallel_launcher' in self.queue_system_parameters:
+                    profilefile.write(f"export PARALLEL_LAUNCHER=\"{self.queue_system_parameters['parallel_launcher']}\"\n")
+                if 'node_hostnames' in self.queue_system_parameters:
+                    profilefile.write(f"export NODE_HOSTNAMES=$({self.queue_system_parameters['node_hostnames']} | "
+                                      f"tr '\\n' ' ')\n")
             else:
                 profilefile.write('\n')
                 profilefile.write('export WORKING_DIR={}\n'.format(self.work_dir))
@@ -432,27 +441,33 @@ class Script:
             profilefile.write(f'export PYTHON_INSTANCE={sys.executable}')
             profilefile.write('\n')
             if self.profiling is not None:
+                overhead.define_functions(profilefile)
                 for key in self.profiling.keys():
+                    profilefile.write(f'pyprofqueue_phase_start init_{key}\n')
                     self.initialise_profiling(key, profilefile)
+                    profilefile.write(f'pyprofqueue_phase_end init_{key}\n')
 
-                profilefile.write('export START_TIME=$(date +%s)\n')
-                profilefile.write('sleep 15\n\n')
+                profilefile.write('export START_TIME=$(date +%s)\n\n')
+                profilefile.write('pyprofqueue_phase_start work\n')
                 for key in self.profiling.keys():
                     self.run_work_profiling(key, profilefile, bash_options)
                 if not self.at_execute:
                     self.run_work(profilefile, bash_options)
-                profilefile.write('sleep 15\n')
+                profilefile.write('pyprofqueue_phase_end work\n')
                 profilefile.write('export END_TIME=$(date +%s)\n')
                 profilefile.write('export DURATION=$((${END_TIME} - ${START_TIME}))\n')
                 profilefile.write('export START=$(date -d @${START_TIME} +"%Y-%m-%d %H:%M:%S")\n')
                 profilefile.write('export END=$(date -d @${END_TIME} +"%Y-%m-%d %H:%M:%S")\n\n')
                 for key in self.profiling.keys():
+                    profilefile.write(f'pyprofqueue_phase_start end_{key}\n')
                     self.end_profiling(key, profilefile)
+                    profilefile.write(f'pyprofqueue_phase_end end_{key}\n')
+                profilefile.write('${PYTHON_INSTANCE} -c "import pyprofqueue.overhead as overhead; '
+                                  'overhead.summarise(\'${PYPROFQUEUE_OVERHEAD_FILE}\')"\n')
+                profilefile.write('rm -f ${PYPROFQUEUE_OVERHEAD_FILE}.times\n')
             else:
                 profilefile.write('export START_TIME=$(date +%s)\n')
-                profilefile.write('sleep 10\n')
                 self.run_work(profilefile, bash_options)
-                profilefile.write('sleep 10\n')
                 profilefile.write('export END_TIME=$(date +%s)\n')
                 profilefile.write('export DURATION=$((${END_TIME} - ${START_TIME}))\n')
                 profilefile.write('export START=$(date -d @${START_TIME} +"%Y-%m-%d %H:%M:%S")\n')